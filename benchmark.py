@@ -0,0 +1,298 @@
+# benchmark.py, reproducible data server benchmarks
+#
+# Starts a data server in a subprocess on a free localhost port, runs the
+# selected scenarios against it and writes the results as JSON, e.g.:
+#
+#   python benchmark.py --scenarios append,setitem --output bench.json
+#
+# Every scenario reports latency percentiles (ms), throughput and the
+# server's resident memory before and after.
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+SCENARIOS = ('append', 'setitem', 'file_churn', 'concurrent', 'fanout')
+SERVER_TIMEOUT = 20     # s
+
+def free_port(n=1):
+    '''
+    Return a port p such that p ... p + n - 1 are free on localhost.
+    '''
+    while True:
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        socks = []
+        try:
+            for i in range(1, n):
+                t = socket.socket()
+                socks.append(t)
+                t.bind(('127.0.0.1', port + i))
+            return port
+        except socket.error:
+            pass
+        finally:
+            for t in socks:
+                t.close()
+
+def server_rss(pid):
+    '''
+    Return the resident memory of process <pid> in bytes, or None.
+    '''
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+
+def latency_stats(latencies):
+    lat = np.asarray(latencies) * 1000
+    if len(lat) == 0:
+        return dict(count=0)
+    return dict(
+        count=len(lat),
+        p50_ms=float(np.percentile(lat, 50)),
+        p95_ms=float(np.percentile(lat, 95)),
+        p99_ms=float(np.percentile(lat, 99)),
+        max_ms=float(lat.max()),
+    )
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+def connect(port):
+    '''
+    Connect to the data server on <port>, waiting until it is up.
+    '''
+    import dataserver_helpers as dsh
+    start = time.time()
+    while True:
+        try:
+            client = dsh.dataserver_client(serverport=port)
+            if client is not None and client.hello() == 'hello':
+                return client
+        except Exception:
+            pass
+        if time.time() - start > SERVER_TIMEOUT:
+            raise Exception('Data server on port %d did not start' % (port, ))
+        time.sleep(0.2)
+
+def spawn(args, port, *extra):
+    '''
+    Run this script as a helper process in mode <args>.
+    '''
+    cmd = [sys.executable, os.path.abspath(__file__), '--port', str(port), '--role'] + list(args) + list(extra)
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+# Scenarios, each returning a dict of results
+
+def bench_append(client, opts):
+    f = client.get_file(os.path.join(opts.dir, 'bench_append.h5'))
+    ds = f.create_dataset('data', rank=1, dtype=np.float64)
+    lat = [timed(ds.append, float(i)) for i in range(opts.appends)]
+    ret = latency_stats(lat)
+    ret['ops_per_s'] = len(lat) / sum(lat)
+    f.close()
+    return ret
+
+def bench_setitem(client, opts):
+    import dataserver_helpers as dsh
+    f = client.get_file(os.path.join(opts.dir, 'bench_setitem.h5'))
+    ret = {}
+    for n in opts.sizes:
+        ds = f.create_dataset('data%d' % n, shape=(n, ), dtype=np.float64)
+        ar = np.random.rand(n)
+        def set_rpc():
+            ds[:] = ar
+        res = {}
+        for name, setter, getter in (
+                ('rpc', set_rpc, lambda: ds[:]),
+                ('shm', lambda: dsh.fast_set(ds, slice(None), ar, client, 0),
+                        lambda: dsh.fast_get(ds, slice(None), client, 0))):
+            if name == 'shm' and dsh.shm_dir(client) is None:
+                continue
+            lat = [timed(setter) for i in range(opts.repeat)]
+            res['set_' + name] = latency_stats(lat)
+            res['set_' + name]['MB_per_s'] = ar.nbytes * len(lat) / sum(lat) / 1e6
+            lat = [timed(getter) for i in range(opts.repeat)]
+            res['get_' + name] = latency_stats(lat)
+            res['get_' + name]['MB_per_s'] = ar.nbytes * len(lat) / sum(lat) / 1e6
+        ret[str(ar.nbytes)] = res
+    f.close()
+    return ret
+
+def bench_file_churn(client, opts):
+    fns = [os.path.join(opts.dir, 'bench_churn%d.h5' % i) for i in range(opts.files)]
+    lat_get = []
+    lat_rec = []
+    for i in range(opts.records):
+        fn = fns[np.random.randint(len(fns))]
+        start = time.time()
+        f = client.get_file(fn)
+        lat_get.append(time.time() - start)
+        ar = np.random.rand(opts.arlen)
+        start = time.time()
+        g = f.create_dataset('rec%d' % i, data=ar)
+        if np.count_nonzero(g[:] != ar) != 0:
+            raise Exception('Array does not match')
+        lat_rec.append(time.time() - start)
+    for fn in fns:
+        client.remove_file(fn)
+    return dict(get_file=latency_stats(lat_get), record=latency_stats(lat_rec),
+                records_per_s=len(lat_rec) / (sum(lat_get) + sum(lat_rec)))
+
+def bench_concurrent(client, opts):
+    procs = [spawn(['append_client', str(i)], opts.port, '--dir', opts.dir, '--appends', str(opts.appends))
+             for i in range(opts.clients)]
+    results = [json.loads(p.communicate()[0]) for p in procs]
+    lat = sum((r['latencies'] for r in results), [])
+    ret = latency_stats(lat)
+    ret['clients'] = opts.clients
+    ret['ops_per_s'] = len(lat) / (max(r['end'] for r in results) - min(r['start'] for r in results))
+    return ret
+
+def bench_fanout(client, opts):
+    fn = os.path.join(opts.dir, 'bench_fanout.h5')
+    f = client.get_file(fn)
+    g = f.create_group('fanout')
+    procs = [spawn(['subscriber', fn], opts.port, '--updates', str(opts.updates))
+             for i in range(opts.subscribers)]
+    for p in procs:
+        p.stdout.readline()     # Wait for 'ready'
+    ar = np.arange(10)
+    start = time.time()
+    lat = []
+    for i in range(opts.updates):
+        lat.append(timed(g.__setitem__, 'data', ar))
+    results = [json.loads(p.communicate()[0]) for p in procs]
+    received = sum(r['received'] for r in results)
+    ret = dict(subscribers=opts.subscribers, updates=opts.updates, write=latency_stats(lat),
+               received=received, lost=opts.updates * opts.subscribers - received)
+    last = [r['last'] for r in results if r['last'] is not None]
+    if last:
+        ret['delivered_per_s'] = received / (max(last) - start)
+    f.close()
+    return ret
+
+# Helper process roles
+
+def role_append_client(client, opts, index):
+    f = client.get_file(os.path.join(opts.dir, 'bench_concurrent%s.h5' % index))
+    ds = f.create_dataset('data', rank=1, dtype=np.float64)
+    start = time.time()
+    lat = [timed(ds.append, float(i)) for i in range(opts.appends)]
+    end = time.time()
+    f.close()
+    print json.dumps(dict(latencies=lat, start=start, end=end))
+
+def role_subscriber(client, opts, fn):
+    import objectsharer as objsh
+    state = dict(received=0, last=None, start=time.time())
+    def changed(key, _slice=None):
+        state['received'] += 1
+        state['last'] = time.time()
+    def check():
+        idle = time.time() - (state['last'] or state['start'])
+        if state['received'] >= opts.updates or idle > 5:
+            print json.dumps(dict(received=state['received'], last=state['last']))
+            sys.stdout.flush()
+            os._exit(0)
+        return True
+    g = client.get_file(fn)['fanout']
+    g.connect('changed', changed)
+    print 'ready'
+    sys.stdout.flush()
+    state['start'] = time.time()
+    objsh.helper.backend.timeout_add(100, check)
+    objsh.helper.backend.main_loop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Data server benchmarks')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+        help='comma separated list of: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--workers', type=int, default=0, help='data server worker processes')
+    parser.add_argument('--appends', type=int, default=1000)
+    parser.add_argument('--sizes', default='1000,100000,10000000',
+        help='comma separated array lengths for setitem')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--arlen', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    parser.add_argument('--role', nargs='+', help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    opts.sizes = [int(n) for n in opts.sizes.split(',')]
+
+    if opts.role:
+        client = connect(opts.port)
+        globals()['role_' + opts.role[0]](client, opts, *opts.role[1:])
+        return
+
+    scenarios = opts.scenarios.split(',')
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario %s' % (name, ))
+
+    opts.dir = tempfile.mkdtemp(prefix='dataserver_bench_')
+    opts.port = free_port(1 + opts.workers)
+    server = subprocess.Popen([sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataserver.py'),
+        '--port', str(opts.port), '--workers', str(opts.workers),
+        '--backup-dir', os.path.join(opts.dir, 'backup')], cwd=opts.dir)
+    try:
+        client = connect(opts.port)
+        results = dict(
+            time=time.strftime('%Y-%m-%d %H:%M:%S'),
+            host=platform.node(),
+            python=platform.python_version(),
+            workers=opts.workers,
+            scenarios={},
+        )
+        for name in scenarios:
+            rss_before = server_rss(server.pid)
+            ret = globals()['bench_' + name](client, opts)
+            ret['server_rss_before'] = rss_before
+            ret['server_rss_after'] = server_rss(server.pid)
+            results['scenarios'][name] = ret
+        client.quit(async=True)
+    finally:
+        start = time.time()
+        while server.poll() is None and time.time() - start < SERVER_TIMEOUT:
+            time.sleep(0.1)
+        if server.poll() is None:
+            server.terminate()
+        shutil.rmtree(opts.dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
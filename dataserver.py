@@ -16,7 +16,17 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import sys
+import socket
+import posixpath
+import collections
+import zlib
+import multiprocessing
+import threading
+import functools
+import Queue
 import logging
+import json
 from shutil import copyfile
 
 logging.getLogger().setLevel(logging.INFO)
@@ -25,6 +35,7 @@ import time
 import h5py
 import numpy as np
 import types
+from dataserver_helpers import shm_write, shm_read, SHM_DIR, SHM_MIN_BYTES, SHM_PREFIX, SHM_SUFFIX
 
 COMPLEX_TYPES = [np.complex, np.complex64, np.complex128]
 try:
@@ -35,69 +46,1710 @@ FLOAT_TYPES= (np.float, np.float16, np.float32, np.float64)
 
 #NOTE: the emit functions are provided by objectsharer after calling register()
 
+# Flush modes, see FlushScheduler
+FLUSH_IMMEDIATE = 'immediate'
+FLUSH_TIME = 'time'
+FLUSH_SIZE = 'size'
+FLUSH_CLOSE = 'close'
+FLUSH_MODES = (FLUSH_IMMEDIATE, FLUSH_TIME, FLUSH_SIZE, FLUSH_CLOSE)
+
 try:
     import config
-    if hasattr(config, 'data_backup'):
-        BACKUP_DIR = config.data_backup
 except:
-    BACKUP_DIR = r'C:\_DataBackup'
+    config = None
+
+# Daily backups are written to BACKUP_DIR; an empty value disables them
+BACKUP_DIR = getattr(config, 'data_backup', r'C:\_DataBackup')
+BACKUP_RATE = getattr(config, 'data_backup_rate', 50 * 1024 * 1024)    # bytes/s
+BACKUP_BLOCK = 4 * 1024 * 1024
+# Number of throttled copy attempts before copying with writes blocked,
+# which is abandoned (and retried on the next request) if it takes longer
+# than BACKUP_LOCK_TIME seconds
+BACKUP_RETRIES = 3
+BACKUP_LOCK_TIME = getattr(config, 'data_backup_lock_time', 1.0)
+FLUSH_MODE = getattr(config, 'data_flush_mode', FLUSH_IMMEDIATE)
+FLUSH_INTERVAL = getattr(config, 'data_flush_interval', 500)            # ms
+FLUSH_SIZE_LIMIT = getattr(config, 'data_flush_size', 16 * 1024 * 1024) # bytes
+
+# Interval (in ms) at which the server processes its periodic house keeping
+POLL_INTERVAL = 50
+
+# Server port; worker processes (see start()) use the ports following it
+PORT = getattr(config, 'data_port', 55556)
+WORKERS = getattr(config, 'data_workers', 0)
+WORKER_NAME = 'dataserver-worker%d'
+WORKER_TIMEOUT = 10     # s
+
+# Shared memory segments for same-host clients, see DataSet.get_shm().
+# Segments not picked up by a client within SHM_TIMEOUT seconds are removed.
+SHM_DIR = getattr(config, 'data_shm_dir', SHM_DIR)
+SHM_TIMEOUT = 60
+
+# Growing data sets are over-allocated along axis 0 by at least this factor,
+# their logical length is stored in attribute LENGTH_ATTR until the file is
+# closed and the data set is trimmed.
+GROWTH_FACTOR = getattr(config, 'data_growth_factor', 1.5)
+LENGTH_ATTR = '_length'
+
+# Attributes of ring buffer data sets: capacity, next row to write, whether
+# the buffer has wrapped around and the total number of rows ever written
+RING_ATTR = '_ring'
+RING_HEAD_ATTR = '_ring_head'
+RING_WRAPPED_ATTR = '_ring_wrapped'
+RING_TOTAL_ATTR = '_ring_total'
+
+# Comma separated names of the columns of a table (a data set with a compound
+# data type) that are known to be non-decreasing, see DataSet.append_rows()
+MONOTONIC_ATTR = '_monotonic'
+# DataSet.query() reads at most this many rows at once when bisecting
+SEARCH_BLOCK = 4096
+# Target size in bytes of a chunk, see guess_chunks()
+CHUNK_BYTES = getattr(config, 'data_chunk_bytes', 64 * 1024)
+# Chunk size along axes of which the size is not known yet
+CHUNK_DEFAULT_DIM = 64
+# Chunk size along the non-leading axes for column access
+CHUNK_COLUMN_DIM = 4
+# Minimum number of rows of a chunk sized to the data, see guess_chunks()
+CHUNK_MIN_ROWS = 16
+
+# Expected access patterns, determining the chunk shape
+ACCESS_ROW = 'row'          # Rows (ds[i,...]) or appending along axis 0
+ACCESS_COLUMN = 'column'    # Columns (ds[:,j])
+ACCESS_BLOCK = 'block'      # Rectangular blocks
+ACCESS_PATTERNS = (ACCESS_ROW, ACCESS_COLUMN, ACCESS_BLOCK)
+
+# Storage policies: HDF5 filters applied to new data sets. The policy and
+# access pattern can be set per group (inherited by sub groups) through the
+# POLICY_ATTR and ACCESS_ATTR attributes, or per call to create_dataset().
+STORAGE_POLICIES = {
+    'none': dict(compression=None, compression_opts=None, shuffle=False),
+    'fast': dict(compression='lzf', compression_opts=None, shuffle=True),
+    'compact': dict(compression='gzip', compression_opts=4, shuffle=True),
+}
+STORAGE_POLICIES.update(getattr(config, 'data_storage_policies', {}))
+STORAGE_POLICY = getattr(config, 'data_storage_policy', 'none')
+POLICY_ATTR = 'storage_policy'
+ACCESS_ATTR = 'storage_access'
+# Maximum size in bytes of the blocks read by server-side processing
+READ_BLOCK_BYTES = getattr(config, 'data_read_block', 16 * 1024 * 1024)
+
+# Decimation methods, see DataSet.get_decimated()
+DECIMATE_STRIDE = 'stride'
+DECIMATE_MINMAX = 'minmax'
+DECIMATE_MEAN = 'mean'
+DECIMATE_METHODS = (DECIMATE_STRIDE, DECIMATE_MINMAX, DECIMATE_MEAN)
+
+# Open files with the latest file format by default, allowing them to be
+# switched to SWMR mode with DataServer.start_swmr()
+SWMR = getattr(config, 'data_swmr', False)
+
+# Create data sets resizable (chunked, with unlimited maximum shape), so that
+# assigning an array of a different shape resizes them in place
+RESIZABLE = getattr(config, 'data_resizable', True)
+
+# Reductions supported by DataSet.reduce(); the results of the last
+# REDUCE_CACHE_LENGTH reductions/histograms are cached per data set until it
+# is modified.
+REDUCE_OPS = ('sum', 'mean', 'min', 'max', 'var', 'std', 'count')
+REDUCE_CACHE_LENGTH = 16
+
+# Subscriptions (see Subscription) queue at most SUBSCRIPTION_QUEUE events
+# by default; when full the oldest are dropped or, with the 'latest'
+# policy, events are collapsed to the latest one per signal and key.
+SUBSCRIPTION_QUEUE = getattr(config, 'data_subscription_queue', 1000)
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_LATEST = 'latest'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_LATEST)
+KEYED_SIGNALS = ('changed', 'removed', 'group-added')
+
+# At most MAX_OPEN_FILES files are kept open; the least recently used are
+# closed when more are needed, as are files unused for FILE_IDLE_TIMEOUT
+# seconds. They are reopened when one of their objects is used again.
+# See also DataServer.set_file_pool().
+MAX_OPEN_FILES = getattr(config, 'data_max_open_files', 256)
+FILE_IDLE_TIMEOUT = getattr(config, 'data_file_timeout', 600)
+
+# Number of threads executing calls made through submit()
+IO_THREADS = getattr(config, 'data_io_threads', 4)
+# Methods that can be submitted, per class. Only calls that read or write
+# data qualify: anything that creates, registers or unregisters shared
+# objects, which objectsharer only allows on the main loop thread, or that
+# controls the server has to be called directly.
+SUBMIT_DATASET_METHODS = ('__getitem__', '__setitem__', 'extend', 'append', 'append_rows',
+                          'get_column', 'query', 'read_since', 'read_block', 'get_shm', 'set_shm',
+                          'get_decimated', 'reduce', 'histogram', 'get_chunk_ranges', 'flush')
+SUBMIT_GROUP_METHODS = ('__setitem__', 'get_tree', 'flush')
+SUBMIT_SERVER_METHODS = ('flush_now', )
+
+# Special methods that may be called in a DataServer.batch()
+BATCH_SPECIAL_METHODS = ('__getitem__', '__setitem__', '__delitem__', '__contains__')
+
+# Maximum size in bytes of the cache of recently read slices, 0 disables it
+CACHE_SIZE = getattr(config, 'data_cache_size', 64 * 1024 * 1024)
+
+# If PROXY_EVICT is set, proxies not used for PROXY_IDLE_TIMEOUT seconds are
+# evicted, as are the least recently used ones beyond PROXY_MAX. Checked
+# every EVICT_INTERVAL s. objectsharer does not tell the server which
+# proxies clients still reference or are connected to, so this is off by
+# default; see DataServer.set_proxy_eviction().
+PROXY_EVICT = getattr(config, 'data_proxy_evict', False)
+PROXY_IDLE_TIMEOUT = getattr(config, 'data_proxy_timeout', 3600)
+PROXY_MAX = getattr(config, 'data_proxy_max', 100000)
+EVICT_INTERVAL = 10
+
+# Number of modifications remembered per data set for DataSet.read_since()
+CHANGELOG_LENGTH = 256
+
+# Calls to exposed methods taking longer than SLOW_CALL seconds are logged.
+# If STATS_FILE is set, call statistics are written to it (as JSON) every
+# STATS_INTERVAL seconds.
+SLOW_CALL = getattr(config, 'data_slow_call', 1.0)
+STATS_FILE = getattr(config, 'data_stats_file', None)
+STATS_INTERVAL = getattr(config, 'data_stats_interval', 60)
+STATS_BUCKETS = 32      # Latency histogram buckets, powers of 2 in us
+
+SCALE_ATTRS = ('DIMENSION_SCALE', 'DIMENSION_LIST', 'CLASS', 'NAME', 'REFERENCE_LIST')
+INTERNAL_ATTRS = (LENGTH_ATTR, RING_ATTR, RING_HEAD_ATTR, RING_WRAPPED_ATTR, RING_TOTAL_ATTR, MONOTONIC_ATTR)
+
+def _nbytes(val):
+    '''
+    Return the (approximate) size in bytes of <val> when stored.
+    '''
+    nbytes = getattr(val, 'nbytes', None)
+    if nbytes is None:
+        try:
+            nbytes = np.asarray(val).nbytes
+        except:
+            nbytes = 0
+    return nbytes
+
+class FlushScheduler(object):
+    '''
+    Decides when HDF5 file <h5f> is flushed after being written to.
+
+    Available modes:
+    - FLUSH_IMMEDIATE: flush after every write.
+    - FLUSH_TIME: flush at most every <interval> ms; pending writes are
+      flushed by poll(), which the server calls periodically.
+    - FLUSH_SIZE: flush after <size> bytes have been written.
+    - FLUSH_CLOSE: only flush on flush_now() and when closing the file.
+    '''
+
+    def __init__(self, h5f, lock, mode=None, interval=None, size=None):
+        self._h5f = h5f
+        self._lock = lock
+        self.mode = FLUSH_IMMEDIATE
+        self.interval = FLUSH_INTERVAL
+        self.size = FLUSH_SIZE_LIMIT
+        self.pending = 0
+        self.dirty = False
+        self.held = False
+        self.nwrites = 0
+        self.nflushes = 0
+        self.last_flush = time.time()
+        self.set_mode(mode or FLUSH_MODE, interval, size)
+
+    def set_mode(self, mode, interval=None, size=None):
+        if mode not in FLUSH_MODES:
+            raise ValueError('Unknown flush mode %r, expected one of %s' % (mode, FLUSH_MODES))
+        self.mode = mode
+        if interval is not None:
+            self.interval = interval
+        if size is not None:
+            self.size = size
+        if self.dirty and mode == FLUSH_IMMEDIATE:
+            self.flush_now()
+
+    def hold(self):
+        '''
+        Postpone flushing until resume() is called.
+        '''
+        self.held = True
+
+    def resume(self):
+        self.held = False
+        if self.dirty:
+            self._check()
+
+    def get_mode(self):
+        return dict(mode=self.mode, interval=self.interval, size=self.size,
+                    pending=self.pending, dirty=self.dirty)
+
+    def written(self, nbytes=0):
+        '''
+        Register a write of <nbytes> bytes, flushing if the mode requires.
+        '''
+        self.dirty = True
+        self.pending += nbytes
+        self.nwrites += 1
+        if not self.held:
+            self._check()
+
+    def _check(self):
+        if self.mode == FLUSH_IMMEDIATE:
+            self.flush_now()
+        elif self.mode == FLUSH_SIZE:
+            if self.pending >= self.size:
+                self.flush_now()
+        elif self.mode == FLUSH_TIME:
+            self.poll()
+
+    def poll(self):
+        '''
+        Flush pending writes if the time-based flush interval expired. If
+        another thread holds the file lock, the flush is retried on the
+        next call rather than blocking the main loop.
+        '''
+        if not self.dirty or self.held or self.mode != FLUSH_TIME:
+            return
+        if (time.time() - self.last_flush) * 1000 < self.interval:
+            return
+        if not self._lock.acquire(False):
+            return
+        try:
+            self.flush_now()
+        finally:
+            self._lock.release()
+
+    def flush_now(self):
+        with self._lock:
+            if self._h5f.id:
+                start = time.time()
+                self._h5f.flush()
+                dataserv._stats.flushed(time.time() - start)
+            self.dirty = False
+            self.pending = 0
+            self.nflushes += 1
+            self.last_flush = time.time()
+
+class CallStats(object):
+    '''
+    Statistics of calls to exposed methods: per method the number of calls
+    and errors, a latency histogram, bytes in and out and the time spent
+    flushing versus the remaining time, which is mostly spent in h5py.
+
+    Bucket i of the latency histogram counts calls that took less than 2**i
+    microseconds (and at least 2**(i-1)), the last bucket everything slower.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.flush_count = 0
+            self.flush_time = 0.0
+            self.since = time.time()
+
+    def _flush_time(self):
+        return getattr(self._local, 'flush_time', 0.0)
+
+    def flushed(self, dt):
+        '''
+        Register a file flush that took <dt> seconds.
+        '''
+        self._local.flush_time = self._flush_time() + dt
+        with self._lock:
+            self.flush_count += 1
+            self.flush_time += dt
+
+    def record(self, name, dt, flush_dt, nbytes_in, nbytes_out, error=False):
+        bucket = min(int(dt * 1e6).bit_length(), STATS_BUCKETS - 1)
+        with self._lock:
+            st = self.calls.get(name, None)
+            if st is None:
+                st = dict(count=0, errors=0, time=0.0, max_time=0.0, flush_time=0.0,
+                          bytes_in=0, bytes_out=0, hist=[0] * STATS_BUCKETS)
+                self.calls[name] = st
+            st['count'] += 1
+            st['errors'] += int(error)
+            st['time'] += dt
+            st['max_time'] = max(st['max_time'], dt)
+            st['flush_time'] += flush_dt
+            st['bytes_in'] += nbytes_in
+            st['bytes_out'] += nbytes_out
+            st['hist'][bucket] += 1
+
+    def get_stats(self):
+        with self._lock:
+            calls = {}
+            for name, st in self.calls.iteritems():
+                st = dict(st)
+                st['hist'] = list(st['hist'])
+                st['h5py_time'] = st['time'] - st['flush_time']
+                st['mean_time'] = st['time'] / st['count']
+                calls[name] = st
+            return dict(since=self.since, uptime=time.time() - self.since, calls=calls,
+                        flush_count=self.flush_count, flush_time=self.flush_time)
+
+def _arg_nbytes(args):
+    nbytes = 0
+    for arg in args:
+        if isinstance(arg, (np.ndarray, list)):
+            nbytes += _nbytes(arg)
+    return nbytes
+
+def _call_target(obj, args):
+    '''
+    Describe what a call to <obj> operates on, for logging slow calls.
+    '''
+    if getattr(obj, '_fn', None) is not None:
+        return obj._fn + obj._path
+    if args and isinstance(args[0], basestring):
+        return args[0]
+    return ''
+
+def _emit(obj, signal, *args):
+    '''
+    Emit <signal> from shared object <obj>. The objectsharer backend may
+    only be used from the main loop thread, so signals raised by I/O
+    threads are queued and emitted by DataServer._poll().
+    '''
+    if threading.current_thread() is dataserv._loop_thread:
+        _deliver(obj, signal, args)
+    else:
+        dataserv._emits.put((obj, signal, args))
+
+def _deliver(obj, signal, args):
+    obj.emit(signal, *args)
+    subs = list(getattr(obj, '_subscriptions', ()))
+    if signal == 'changed' and isinstance(obj, DataGroup):
+        # Data set changes are signalled by the group
+        child = dataserv._datagroups.get(obj._child_fullname(args[0]), None)
+        if child is not None:
+            subs.extend(child._subscriptions)
+    for sub in subs:
+        try:
+            sub._offer(signal, args)
+        except Exception:
+            logging.exception('Failed to queue %s signal for subscription', signal)
+
+def _merge_slices(s1, s2):
+    '''
+    Return a slice covering slices <s1> and <s2>, None for everything.
+    '''
+    if not isinstance(s1, slice) or not isinstance(s2, slice) or \
+            s1.step not in (None, 1) or s2.step not in (None, 1):
+        return None
+    if s1.start is None or s2.start is None:
+        start = None
+    else:
+        start = min(s1.start, s2.start)
+    if s1.stop is None or s2.stop is None:
+        stop = None
+    else:
+        stop = max(s1.stop, s2.stop)
+    return slice(start, stop)
+
+class Subscription(object):
+    '''
+    Filtered, bounded subscription to the signals of a DataGroup or DataSet,
+    created by their subscribe() method.
+
+    Signals are queued rather than sent: the subscriber is notified with a
+    'pending' signal (carrying the number of queued events), at most once
+    per <min_interval> ms and not again until it calls fetch(). A slow
+    subscriber therefore never builds up more than <maxlen> events on the
+    server. Overflow <policy> is one of OVERFLOW_POLICIES.
+    '''
+
+    def __init__(self, obj, keys=None, signals=None, min_interval=0,
+                 maxlen=SUBSCRIPTION_QUEUE, policy=OVERFLOW_DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %r, expected one of %s' % (policy, OVERFLOW_POLICIES))
+        self._obj = obj
+        self._keys = set(keys) if keys is not None else None
+        self._signals = set(signals) if signals is not None else None
+        self.min_interval = min_interval
+        self.maxlen = max(1, maxlen)
+        self.policy = policy
+        self._queue = collections.OrderedDict()
+        self._seq = 0
+        self._notified = False
+        self._last_notify = 0
+        self.created = time.time()
+        self.last_fetch = None
+        self.queued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+        obj._subscriptions.append(self)
+        dataserv._subscriptions.add(self)
+        objsh.register(self)
+
+    def _offer(self, signal, args):
+        if self._signals is not None and signal not in self._signals:
+            return
+        if self._keys is not None and signal in KEYED_SIGNALS and args[0] not in self._keys:
+            return
+        self.queued += 1
+        if self.policy == OVERFLOW_LATEST:
+            # Only the first argument of keyed signals names a child; that
+            # of others (e.g. the shape of 'resize' or the attributes of
+            # 'attrs-changed') need not be hashable.
+            key = (signal, args[0] if signal in KEYED_SIGNALS and args else None)
+            old = self._queue.pop(key, None)
+            if old is not None:
+                if signal == 'changed' and len(args) > 1:
+                    args = (args[0], _merge_slices(old[1][1], args[1]))
+                self.dropped += 1
+                self._queue[key] = (old[0], args)
+            else:
+                self._queue[key] = (time.time(), args)
+        else:
+            self._seq += 1
+            self._queue[(signal, self._seq)] = (time.time(), args)
+        while len(self._queue) > self.maxlen:
+            self._queue.popitem(last=False)
+            self.dropped += 1
+
+    def _poll(self):
+        if self._notified or not self._queue:
+            return
+        if (time.time() - self._last_notify) * 1000 < self.min_interval:
+            return
+        self._notified = True
+        self._last_notify = time.time()
+        self.emit('pending', len(self._queue))
+
+    def fetch(self, max_events=None):
+        '''
+        Return and remove up to <max_events> queued events (all if None),
+        oldest first, as (signal, args) tuples. This also acknowledges the
+        'pending' notification.
+        '''
+        now = time.time()
+        ret = []
+        while self._queue and (max_events is None or len(ret) < max_events):
+            (signal, key), (t, args) = self._queue.popitem(last=False)
+            self.max_lag = max(self.max_lag, now - t)
+            ret.append((signal, args))
+        self.delivered += len(ret)
+        self.last_fetch = now
+        self._notified = False
+        return ret
+
+    def get_stats(self):
+        '''
+        Return counts of queued, delivered and dropped events, the current
+        queue length, the age of the oldest queued event and the largest
+        delay between queueing and fetching an event (lag, in seconds).
+        '''
+        now = time.time()
+        oldest = next(self._queue.itervalues())[0] if self._queue else now
+        return dict(fullname=_call_target(self._obj, ()), policy=self.policy,
+                    min_interval=self.min_interval, maxlen=self.maxlen,
+                    length=len(self._queue), queued=self.queued, delivered=self.delivered,
+                    dropped=self.dropped, lag=now - oldest, max_lag=self.max_lag,
+                    last_fetch=self.last_fetch)
 
+    def release(self):
+        '''
+        Cancel this subscription.
+        '''
+        if self in self._obj._subscriptions:
+            self._obj._subscriptions.remove(self)
+        dataserv._subscriptions.discard(self)
+        objsh.helper.unregister(self)
+
+def _check_submit(obj, method):
+    '''
+    Raise ValueError if <method> of <obj> can not be called on an I/O
+    thread, i.e. if it is not in SUBMIT_DATASET_METHODS,
+    SUBMIT_GROUP_METHODS or SUBMIT_SERVER_METHODS for the type of <obj>.
+    '''
+    if isinstance(obj, DataSet):
+        allowed = SUBMIT_DATASET_METHODS
+    elif isinstance(obj, DataGroup):
+        allowed = SUBMIT_GROUP_METHODS
+    else:
+        allowed = SUBMIT_SERVER_METHODS
+    if method not in allowed:
+        raise ValueError('Method %s cannot be submitted' % (method, ))
+
+def _submit(obj, method, args, kwargs):
+    _check_submit(obj, method)
+    return dataserv._io.submit(obj._fn, getattr(obj, method), *args, **kwargs)
+
+class PendingResult(object):
+    '''
+    Shared handle to the result of a call made through submit(). Emits
+    'done' (with True on success, False on failure) when the call has
+    finished, after which get_result() returns the result.
+    '''
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        objsh.register(self)
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception, e:
+            logging.exception('Submitted call failed')
+            self._error = e
+        self._done.set()
+        _emit(self, 'done', self._error is None)
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def get_result(self):
+        '''
+        Return the result of the call, or raise the exception it raised.
+        The handle is released afterwards.
+        '''
+        if not self._done.is_set():
+            raise Exception('Call has not finished yet')
+        objsh.helper.unregister(self)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class IOExecutor(object):
+    '''
+    Executes calls on <nthreads> threads, so that the main loop stays
+    responsive during long HDF5 reads, writes and flushes. Calls for the
+    same file are executed one at a time, in the order of submission.
+    Threads are started on first use.
+    '''
+
+    def __init__(self, nthreads):
+        self.nthreads = nthreads
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._ready = Queue.Queue()
+        self._threads = []
+        self.submitted = 0
+        self.completed = 0
+
+    def submit(self, key, func, *args, **kwargs):
+        '''
+        Queue func(*args, **kwargs) for file <key> and return a
+        PendingResult.
+        '''
+        pending = PendingResult()
+        with self._lock:
+            if not self._threads:
+                for i in range(max(1, self.nthreads)):
+                    t = threading.Thread(target=self._run, name='dataserver-io%d' % i)
+                    t.daemon = True
+                    t.start()
+                    self._threads.append(t)
+            self.submitted += 1
+            queue = self._queues.get(key, None)
+            if queue is None:
+                # Not queued or running: make the file available to a thread
+                self._queues[key] = collections.deque([(pending, func, args, kwargs)])
+                self._ready.put(key)
+            else:
+                queue.append((pending, func, args, kwargs))
+        return pending
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                pending, func, args, kwargs = self._queues[key][0]
+            pending._run(func, args, kwargs)
+            with self._lock:
+                queue = self._queues[key]
+                queue.popleft()
+                self.completed += 1
+                if queue:
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(threads=len(self._threads), submitted=self.submitted, completed=self.completed,
+                        pending=self.submitted - self.completed, files=len(self._queues))
+
+    def shutdown(self, timeout=None):
+        '''
+        Stop the threads after they finish the calls already queued.
+        '''
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for t in threads:
+            self._ready.put(None)
+        for t in threads:
+            t.join(timeout)
+
+def _h5f_property():
+    '''
+    Return the _h5f property of DataGroup and DataSet proxies, which
+    refers to the HDF5 object and reopens its file if the file pool closed
+    it since the object was last used (see DataServer._get_h5file()).
+    '''
+    def get(self):
+        if self._gen is not None and self._gen != dataserv._file_gen.get(self._fn, None):
+            self._rebind(dataserv._get_h5file(self._fn)[self._path])
+        else:
+            dataserv._file_atime[self._fn] = time.time()
+        return self._h5obj
+
+    def set(self, h5f):
+        self._h5obj = h5f
+        if h5f is None:
+            self._gen = None
+            return
+        self._fn = h5f.file.filename
+        self._path = h5f.name
+        self._gen = dataserv._file_gen.get(self._fn, None)
+
+    return property(get, set)
+
+def _locked(func):
+    '''
+    Decorator for methods that modify a file, holding the file's lock while
+    they run so that other threads (e.g. the backup service) can exclude
+    writes.
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with dataserv._get_lock(self._fn):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+# Special methods that clients call on DataGroup and DataSet objects
+EXPOSED_SPECIAL_METHODS = ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__len__')
+
+def _exposed(cls):
+    '''
+    Class decorator wrapping the methods clients can call, i.e. the public
+    ones and EXPOSED_SPECIAL_METHODS, to record the time of last use and
+    call statistics.
+    '''
+    for name, func in cls.__dict__.items():
+        if not isinstance(func, types.FunctionType):
+            continue
+        if name.startswith('_') and name not in EXPOSED_SPECIAL_METHODS:
+            continue
+        setattr(cls, name, _wrap_exposed(func, '%s.%s' % (cls.__name__, name)))
+    return cls
+
+def _wrap_exposed(func, statname):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self._atime = start = time.time()
+        stats = dataserv._stats
+        flush_start = stats._flush_time()
+        ret = None
+        error = True
+        try:
+            ret = func(self, *args, **kwargs)
+            error = False
+            return ret
+        finally:
+            dt = time.time() - start
+            nbytes_out = ret.nbytes if isinstance(ret, np.ndarray) else 0
+            stats.record(statname, dt, stats._flush_time() - flush_start,
+                         _arg_nbytes(args) + _arg_nbytes(kwargs.values()), nbytes_out, error)
+            if dt > SLOW_CALL:
+                logging.warning('Slow call %s on %s took %.3f s', statname, _call_target(self, args), dt)
+    return wrapper
+
+def _row_range(idx, nrows):
+    '''
+    Return the (start, stop) range of rows (axis 0) addressed by index <idx>
+    in a data set with <nrows> rows, or None if it cannot be determined.
+    '''
+    if isinstance(idx, tuple):
+        if len(idx) == 0:
+            return (0, nrows)
+        idx = idx[0]
+    if idx is None or idx is Ellipsis:
+        return (0, nrows)
+    if isinstance(idx, slice):
+        start, stop, step = idx.indices(nrows)
+        if step < 0:
+            start, stop = stop + 1, start + 1
+        return (start, max(start, stop))
+    if isinstance(idx, (int, long, np.integer)):
+        if idx < 0:
+            idx += nrows
+        return (idx, idx + 1)
+    try:
+        idx = np.asarray(idx)
+        if idx.dtype == np.bool:
+            idx = np.flatnonzero(idx)
+        if idx.size == 0:
+            return (0, 0)
+        idx = np.where(idx < 0, idx + nrows, idx)
+        return (int(idx.min()), int(idx.max()) + 1)
+    except:
+        return None
+
+def _merge_ranges(r1, r2):
+    '''
+    Return the smallest row range covering both <r1> and <r2>, None meaning
+    everything.
+    '''
+    if r1 is None or r2 is None:
+        return None
+    return (min(r1[0], r2[0]), max(r1[1], r2[1]))
+
+def guess_chunks(shape, dtype, access=ACCESS_ROW, maxshape=None, nbytes=None):
+    '''
+    Return a chunk shape of about <nbytes> (default CHUNK_BYTES) bytes for
+    a data set of <shape> and <dtype>, suited to access pattern <access>.
+    Axes of size 0 (i.e. yet unknown) count as CHUNK_DEFAULT_DIM.
+
+    Along axis 0 chunks are at most the number of rows rounded up to a
+    power of two (and at least CHUNK_MIN_ROWS), so that small resizable
+    data sets do not take a whole chunk of CHUNK_BYTES on disk.
+    '''
+    if len(shape) == 0:
+        return None
+    if access not in ACCESS_PATTERNS:
+        raise ValueError('Unknown access pattern %r, expected one of %s' % (access, ACCESS_PATTERNS))
+    if nbytes is None:
+        nbytes = CHUNK_BYTES
+    nitems = max(1, nbytes // np.dtype(dtype).itemsize)
+    dims = [s if s > 0 else CHUNK_DEFAULT_DIM for s in shape]
+
+    if access == ACCESS_ROW:
+        inner = dims[1:]
+    elif access == ACCESS_COLUMN:
+        inner = [min(s, CHUNK_COLUMN_DIM) for s in dims[1:]]
+    else:
+        side = max(1, int(round(nitems ** (1.0 / len(dims)))))
+        inner = [min(s, side) for s in dims[1:]]
+    rows = max(1, nitems // max(1, int(np.prod(inner))))
+    chunks = [rows] + inner
+
+    if shape[0] > 0:
+        chunks[0] = min(chunks[0], max(CHUNK_MIN_ROWS, 1 << (int(shape[0]) - 1).bit_length()))
+
+    # Chunks can not be larger than fixed dimensions
+    if maxshape is None:
+        maxshape = shape
+    for i, m in enumerate(maxshape):
+        if m is not None and m > 0:
+            chunks[i] = min(chunks[i], m)
+    return tuple(int(c) for c in chunks)
+
+def storage_options(shape, dtype, policy=None, access=None, maxshape=None):
+    '''
+    Return the h5py create_dataset() options (chunks, compression,
+    compression_opts and shuffle) for storage policy <policy> and access
+    pattern <access>. Data sets are chunked when they are resizable or
+    filtered. Scalars can be neither, so no options are returned for them.
+    '''
+    if policy is None:
+        policy = STORAGE_POLICY
+    if policy not in STORAGE_POLICIES:
+        raise ValueError('Unknown storage policy %r, expected one of %s' % (policy, STORAGE_POLICIES.keys()))
+    if len(shape) == 0:
+        return dict(chunks=None)
+    opts = dict(STORAGE_POLICIES[policy])
+    resizable = maxshape is not None and maxshape != tuple(shape)
+    if resizable or opts['compression'] or opts['shuffle']:
+        opts['chunks'] = guess_chunks(shape, dtype, access or ACCESS_ROW, maxshape)
+    else:
+        opts['chunks'] = None
+    return opts
+
+def _trim_dataset(h5f):
+    '''
+    Shrink over-allocated HDF5 data set <h5f> to its logical length.
+    '''
+    if LENGTH_ATTR not in h5f.attrs:
+        return
+    shape = list(h5f.shape)
+    shape[0] = h5f.attrs[LENGTH_ATTR]
+    h5f.resize(shape)
+    del h5f.attrs[LENGTH_ATTR]
+
+def _copy_file(src, dst):
+    '''
+    Copy the contents of HDF5 file <src> to <dst>. Dimension scales are
+    attached again, as the references to them are copied verbatim.
+    '''
+    for k, v in src.attrs.items():
+        dst.attrs[k] = v
+    for key in src:
+        src.copy(key, dst)
+    scales = []
+    def visit(name, obj):
+        if not isinstance(obj, h5py.Dataset):
+            return
+        for attr in ('DIMENSION_LIST', 'REFERENCE_LIST'):
+            if attr in dst[name].attrs:
+                del dst[name].attrs[attr]
+        for i, dim in enumerate(obj.dims):
+            for scale in dim.values():
+                scales.append((name, i, scale.name))
+    src.visititems(visit)
+    for name, i, scale in scales:
+        dst[name].dims[i].attach_scale(dst[scale])
+
+def _hard_linked(h5f):
+    '''
+    Return the names of the objects in HDF5 file or group <h5f> that are
+    reachable through more than one hard link.
+    '''
+    names = []
+    def visit(name, obj):
+        if h5py.h5o.get_info(obj.id).rc > 1:
+            names.append(name)
+    h5f.visititems(visit)
+    return names
+
+def _bin_reduce(ufunc, data, bins):
+    '''
+    Reduce array <data> with <ufunc> in bins of bins[i] elements along
+    axis i. The last bin along every axis may be smaller.
+    '''
+    for axis, b in enumerate(bins):
+        if b > 1:
+            data = ufunc.reduceat(data, np.arange(0, data.shape[axis], b), axis=axis)
+    return data
+
+def _node_tree(h5f, depth=None, include_attrs=True):
+    '''
+    Return a nested dict describing HDF5 group or data set <h5f> and, up to
+    <depth> levels deep, its children. See DataGroup.get_tree().
+    '''
+    node = dict(name=h5f.name.split('/')[-1])
+    if include_attrs:
+        node['attrs'] = {k: h5f.attrs[k] for k in h5f.attrs if k not in SCALE_ATTRS + INTERNAL_ATTRS}
+    if isinstance(h5f, h5py.Dataset):
+        shape = h5f.shape
+        length = h5f.attrs.get(LENGTH_ATTR, None)
+        if RING_ATTR in h5f.attrs:
+            length = h5f.attrs[RING_ATTR] if h5f.attrs[RING_WRAPPED_ATTR] else h5f.attrs[RING_HEAD_ATTR]
+            node['ring'] = int(h5f.attrs[RING_ATTR])
+        if length is not None:
+            shape = (int(length), ) + shape[1:]
+        node.update(type='dataset', shape=shape, dtype=h5f.dtype.str if h5f.dtype.names is None
+                    else h5f.dtype.descr, chunks=h5f.chunks)
+        return node
+
+    node['type'] = 'group'
+    if depth is not None and depth <= 0:
+        node['nchildren'] = len(h5f)
+        return node
+    children = []
+    for key in h5f.keys():
+        child = h5f.get(key, None)
+        if child is None:
+            children.append(dict(name=key, type='link'))
+        else:
+            children.append(_node_tree(child, None if depth is None else depth - 1, include_attrs))
+    node['children'] = children
+    return node
+
+def _monotonic_columns(dtype, data=None):
+    '''
+    Return the numeric columns of table data type <dtype>, restricted to
+    those that are non-decreasing in structured array <data> if given.
+    '''
+    columns = [c for c in dtype.names if np.issubdtype(dtype[c], np.number)]
+    if data is not None:
+        columns = [c for c in columns if np.all(data[c][1:] >= data[c][:-1])]
+    return columns
+
+def _select_fields(rows, fields):
+    '''
+    Return structured array <rows> with only the fields in <fields>, or
+    unchanged if <fields> is empty. The result is always a structured
+    array, even for a single field.
+    '''
+    if not fields:
+        return rows
+    part = np.empty(len(rows), dtype=[(f, rows.dtype[f]) for f in fields])
+    for f in fields:
+        part[f] = rows[f]
+    return part
+
+def _len(shape):
+    '''
+    Return the number of rows for <shape>, 0 for scalars.
+    '''
+    if len(shape) == 0:
+        return 0
+    return shape[0]
+
+def _range_slice(rows):
+    if rows is None:
+        return None
+    return slice(rows[0], rows[1])
+
+def _cache_key(idx, shape):
+    '''
+    Return a hashable, normalized version of index <idx> into a data set of
+    <shape>, or None if the index is not suitable for caching.
+    '''
+    if not isinstance(idx, tuple):
+        idx = (idx, )
+    if len(idx) > len(shape):
+        return None
+    key = []
+    for i, n in zip(idx, shape):
+        if isinstance(i, slice):
+            key.append(i.indices(n))
+        elif isinstance(i, (int, long, np.integer)):
+            key.append(int(i) + n if i < 0 else int(i))
+        else:
+            return None
+    return tuple(key)
+
+class SliceCache(object):
+    '''
+    LRU cache of data read from data sets, bounded to <maxbytes> bytes.
+
+    Entries are keyed by data set full name and normalized index, and
+    remember the rows they cover so that writes only invalidate the entries
+    they overlap.
+    '''
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, fullname, key):
+        with self._lock:
+            entry = self._entries.pop((fullname, key), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[(fullname, key)] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, fullname, key, data, rows):
+        nbytes = _nbytes(data)
+        if nbytes > self.maxbytes:
+            return
+        with self._lock:
+            self._remove((fullname, key))
+            self._entries[(fullname, key)] = (data, rows, nbytes)
+            self._keys.setdefault(fullname, set()).add(key)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, k):
+        entry = self._entries.pop(k, None)
+        if entry is None:
+            return
+        self.nbytes -= entry[2]
+        keys = self._keys[k[0]]
+        keys.discard(k[1])
+        if not keys:
+            del self._keys[k[0]]
+
+    def invalidate(self, fullname, rows=None):
+        '''
+        Drop entries of data set <fullname> overlapping <rows>, a (start,
+        stop) range along axis 0, or all entries if rows is None.
+        '''
+        with self._lock:
+            for key in list(self._keys.get(fullname, ())):
+                r = self._entries[(fullname, key)][1]
+                if rows is None or r is None or (r[0] < rows[1] and rows[0] < r[1]):
+                    self._remove((fullname, key))
+                    self.invalidations += 1
+
+    def invalidate_tree(self, name):
+        '''
+        Drop all entries for data set <name> and everything below it.
+        '''
+        with self._lock:
+            names = [n for n in self._keys if n == name or n.startswith(name.rstrip('/') + '/')]
+            for n in names:
+                for key in list(self._keys[n]):
+                    self._remove((n, key))
+                    self.invalidations += 1
+
+    def set_size(self, maxbytes):
+        with self._lock:
+            self.maxbytes = maxbytes
+            while self.nbytes > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    invalidations=self.invalidations, entries=len(self._entries),
+                    nbytes=self.nbytes, maxbytes=self.maxbytes)
+
+class ProxyRegistry(object):
+    '''
+    Registry of DataGroup and DataSet proxies by full name (file name +
+    HDF5 path). Proxies are also indexed as a tree per file, so removing a
+    file or subtree only visits the proxies inside it.
+    '''
+
+    def __init__(self):
+        self._proxies = {}
+        self._children = {}
+        self._parents = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        return name in self._proxies
+
+    def __getitem__(self, name):
+        return self._proxies[name]
+
+    def __len__(self):
+        return len(self._proxies)
+
+    def get(self, name, default=None):
+        return self._proxies.get(name, default)
+
+    def items(self):
+        with self._lock:
+            return self._proxies.items()
+
+    def add(self, fn, path, proxy):
+        with self._lock:
+            name = fn + path
+            self._proxies[name] = proxy
+            while path != '/':
+                path = posixpath.dirname(path)
+                parent = fn + path
+                self._parents[name] = parent
+                children = self._children.setdefault(parent, set())
+                if name in children:
+                    break
+                children.add(name)
+                name = parent
+
+    def is_leaf(self, name):
+        return not self._children.get(name, None)
+
+    def pop(self, name):
+        with self._lock:
+            proxy = self._proxies.pop(name)
+            self._unlink(name)
+            return proxy
+
+    def _unlink(self, name):
+        '''
+        Remove index entries for <name> and its ancestors that no longer
+        lead to a registered proxy.
+        '''
+        while name not in self._proxies and self.is_leaf(name):
+            self._children.pop(name, None)
+            parent = self._parents.pop(name, None)
+            if parent is None:
+                break
+            self._children[parent].discard(name)
+            name = parent
+
+    def pop_tree(self, name):
+        '''
+        Remove <name> and all proxies below it, returning the proxies.
+        '''
+        proxies = []
+        todo = [name]
+        with self._lock:
+            while todo:
+                n = todo.pop()
+                todo.extend(self._children.pop(n, ()))
+                if n != name:
+                    self._parents.pop(n, None)
+                if n in self._proxies:
+                    proxies.append(self._proxies.pop(n))
+            self._unlink(name)
+        return proxies
+
+class SignalCoalescer(object):
+    '''
+    Collects 'changed' and 'resize' signals for <window> ms and emits them
+    merged: one 'changed' per key covering the union of the changed rows
+    (as a slice along axis 0, or None for everything) and only the final
+    shape for 'resize'.
+
+    'changed' is emitted by <changed_obj>, 'resize' by the object passed to
+    add_resize(), <resize_obj> by default. A group's coalescer thus emits
+    'resize' once per resized child data set.
+    '''
+
+    def __init__(self, window, changed_obj, resize_obj=None):
+        self.window = window
+        self._changed_obj = changed_obj
+        self._resize_obj = resize_obj
+        self._changed = {}
+        self._keys = []
+        self._resize = collections.OrderedDict()
+        self._first = None
+        self._lock = threading.Lock()
+
+    def add_changed(self, key, rows):
+        with self._lock:
+            if key in self._changed:
+                self._changed[key] = _merge_ranges(self._changed[key], rows)
+            else:
+                self._changed[key] = rows
+                self._keys.append(key)
+            if self._first is None:
+                self._first = time.time()
+
+    def add_resize(self, shape, obj=None):
+        if obj is None:
+            obj = self._resize_obj
+        with self._lock:
+            self._resize[id(obj)] = (obj, shape)
+            if self._first is None:
+                self._first = time.time()
+
+    def poll(self):
+        if self._first is None:
+            return
+        if (time.time() - self._first) * 1000 >= self.window:
+            self.flush()
+
+    def flush(self):
+        '''
+        Emit all pending signals.
+        '''
+        with self._lock:
+            changed, keys, resize = self._changed, self._keys, self._resize
+            self._changed, self._keys, self._resize = {}, [], collections.OrderedDict()
+            self._first = None
+        for obj, shape in resize.values():
+            _emit(obj, 'resize', shape)
+        for key in keys:
+            _emit(self._changed_obj, 'changed', key, _range_slice(changed[key]))
+
+@_exposed
 class DataSet(object):
     '''
     Shareable wrapper for HDF5 data sets.
     Use indexing ("[:]") to access the actual data.
     '''
 
+    _h5f = _h5f_property()
+
     def __init__(self, h5f, group):
         self._h5f = h5f
         self._group = group
         self._name = h5f.name.split('/')[-1]
-        dataserv._register(self.get_fullname(), self)
+        self._fullname = self.get_fullname()
+        self._atime = time.time()
+        self._coalescer = None
+        self._subscriptions = []
+        self._length = None
+        self._ring = None
+        self._monotonic = None
+        self._version = dataserv._version
+        self._log_start = self._version
+        self._changelog = collections.deque(maxlen=CHANGELOG_LENGTH)
+        self._reduced = collections.OrderedDict()
+        dataserv._register(self)
+        self._rebind(h5f)
+
+    def _rebind(self, h5f):
+        '''
+        Make this proxy refer to HDF5 data set <h5f>.
+        '''
+        self._h5f = h5f
+        self._length = h5f.attrs.get(LENGTH_ATTR, None)
+        if self._length is not None:
+            self._length = int(self._length)
+            dataserv._add_overallocated(h5f)
+        monotonic = h5f.attrs.get(MONOTONIC_ATTR, None)
+        if monotonic is not None:
+            self._monotonic = set(c for c in str(monotonic).split(',') if c)
+        else:
+            self._monotonic = None
+        self._ring = h5f.attrs.get(RING_ATTR, None)
+        if self._ring is not None:
+            self._ring = int(self._ring)
+            self._ring_head = int(h5f.attrs[RING_HEAD_ATTR])
+            self._ring_wrapped = bool(h5f.attrs[RING_WRAPPED_ATTR])
+            self._ring_total = int(h5f.attrs[RING_TOTAL_ATTR])
+
+    def _nrows(self):
+        '''
+        Return the logical number of rows, which is smaller than the
+        allocated number if the data set is over-allocated or a ring buffer
+        that has not wrapped yet.
+        '''
+        if self._ring is not None:
+            return self._ring if self._ring_wrapped else self._ring_head
+        if self._length is not None:
+            return self._length
+        return _len(self._h5f.shape)
+
+    def _logical_index(self, idx):
+        '''
+        Restrict index <idx> to the logical rows of an over-allocated data set.
+        '''
+        nrows = self._nrows()
+        if not isinstance(idx, tuple):
+            idx = (idx, )
+        if len(idx) == 0 or idx[0] is Ellipsis:
+            idx = (slice(None), ) + idx
+        first = idx[0]
+        if isinstance(first, slice):
+            start, stop, step = first.indices(nrows)
+            if stop < 0:
+                stop = None
+            first = slice(start, stop, step)
+        elif isinstance(first, (int, long, np.integer)):
+            if first < 0:
+                first += nrows
+            if not 0 <= first < nrows:
+                raise IndexError('Index (%d) out of range (0-%d)' % (idx[0], nrows - 1))
+        elif first is not None:
+            first = np.asarray(first)
+            if first.dtype == np.bool:
+                first = first[:nrows]
+            else:
+                first = np.where(first < 0, first + nrows, first)
+                if np.any((first < 0) | (first >= nrows)):
+                    raise IndexError('Index out of range (0-%d)' % (nrows - 1, ))
+        return (first, ) + idx[1:]
+
+    def __len__(self):
+        return self._nrows()
 
     def __getitem__(self, idx):
         if type(idx) is types.ListType:
             idx = tuple(idx)
-        return self._h5f[idx]
+        return self._read(idx)
 
+    def _read(self, idx, use_cache=True):
+        '''
+        Return the data at <idx>, from the slice cache if possible.
+        '''
+        if self._ring is not None:
+            return self._ring_read(idx)
+        if self._length is not None:
+            idx = self._logical_index(idx)
+        cache = dataserv._cache
+        key = None
+        if use_cache and cache.maxbytes:
+            key = _cache_key(idx, self.get_shape())
+        if key is None:
+            return self._h5f[idx]
+
+        # Writes invalidate under the file lock, so hold it to avoid caching
+        # data overwritten between reading it and putting it in the cache.
+        # If another thread (a backup or submitted call) holds it, read
+        # without the cache instead of blocking the main loop.
+        lock = dataserv._get_lock(self._fn)
+        if not lock.acquire(False):
+            return self._h5f[idx]
+        try:
+            data = cache.get(self._fullname, key)
+            if data is None:
+                data = self._h5f[idx]
+                cache.put(self._fullname, key, data, _row_range(idx, self._nrows()))
+        finally:
+            lock.release()
+        return data
+
+    @_locked
     def __setitem__(self, idx, val):
         if type(idx) is types.ListType:
             idx = tuple(idx)
+        if self._monotonic:
+            # Rows may be modified arbitrarily
+            self._set_monotonic(())
+        self._write(idx, val)
+
+    def _write(self, idx, val):
+        if self._length is not None or self._ring is not None:
+            idx = self._logical_index(idx)
         if isinstance(val, np.ndarray):
             if val.dtype in COMPLEX_TYPES and self._h5f.dtype not in COMPLEX_TYPES:
                 raise ValueError('Unable to store complex values in non-complex type')
-        self._h5f[idx] = val
-        self.flush()
+        if self._ring is not None:
+            self._ring_write(idx, val)
+        else:
+            self._h5f[idx] = val
+        self._log_change(_row_range(idx, self._nrows()))
+        self._schedule_flush(_nbytes(val))
         self.emit_changed(_slice=idx)
 
+    def _check_table(self, column=None):
+        names = self._h5f.dtype.names
+        if names is None or len(self._h5f.shape) != 1:
+            raise ValueError('Data set %s is not a table' % (self._fullname, ))
+        if column is not None and column not in names:
+            raise ValueError('Table %s has no column %r' % (self._fullname, column))
+
+    def _set_monotonic(self, columns):
+        self._monotonic = set(columns)
+        self._h5f.attrs[MONOTONIC_ATTR] = ','.join(sorted(self._monotonic))
+
+    def _update_monotonic(self, rows):
+        '''
+        Drop the columns that are no longer non-decreasing when <rows> are
+        appended from the monotonic columns.
+        '''
+        if not self._monotonic or len(rows) == 0:
+            return
+        nrows = self._nrows()
+        last = self._read(nrows - 1, use_cache=False) if nrows else None
+        keep = set()
+        for column in self._monotonic:
+            values = rows[column]
+            if not np.all(values[1:] >= values[:-1]):
+                continue
+            if last is not None and not values[0] >= last[column]:
+                continue
+            keep.add(column)
+        if keep != self._monotonic:
+            self._set_monotonic(keep)
+
+    @_locked
+    def append_rows(self, records):
+        '''
+        Append <records> to this table in a single write and return the new
+        number of rows. <records> can be a structured array, a sequence of
+        tuples or a dict of columns (missing columns are zero).
+
+        Numeric columns stay marked as monotonic as long as all values
+        appended (also through extend() and append()) are non-decreasing,
+        which allows query() to bisect them. Writing rows through indexing
+        clears these marks.
+        '''
+        self._check_table()
+        self.extend(records)
+        return self._nrows()
+
+    def _table_rows(self, records):
+        '''
+        Return <records> (see append_rows()) as a structured array with the
+        data type of this table.
+        '''
+        dtype = self._h5f.dtype
+        if isinstance(records, dict):
+            n = len(records.values()[0]) if records else 0
+            data = np.zeros(n, dtype=dtype)
+            for k, v in records.iteritems():
+                data[k] = v
+        elif isinstance(records, np.ndarray) and records.dtype.names is not None:
+            data = np.zeros(len(records), dtype=dtype)
+            for k in records.dtype.names:
+                data[k] = records[k]
+        else:
+            data = np.array([tuple(r) for r in records], dtype=dtype)
+        return data
+
+    def get_column(self, column, _slice=None):
+        '''
+        Return column <column> of self[_slice], without reading the other
+        columns.
+        '''
+        self._check_table(column)
+        if _slice is None:
+            _slice = slice(None)
+        return self._read((_slice, column), use_cache=False)
+
+    def _search(self, column, value, side='left'):
+        '''
+        Return the row at which <value> would be inserted in non-decreasing
+        <column>, see numpy.searchsorted().
+        '''
+        lo, hi = 0, self._nrows()
+        while hi - lo > SEARCH_BLOCK:
+            mid = (lo + hi) // 2
+            v = self._read((mid, column), use_cache=False)
+            if v < value or (side == 'right' and v == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        values = self._read((slice(lo, hi), column), use_cache=False)
+        return lo + int(np.searchsorted(values, value, side=side))
+
+    def query(self, column, lo=None, hi=None, columns=None):
+        '''
+        Return the rows of this table with lo <= row[column] <= hi as a
+        structured array, with only the fields in <columns> if given.
+        Either bound can be None.
+
+        If <column> is monotonic (see append_rows()) the rows are found by
+        binary search, otherwise the table is scanned in blocks of about
+        READ_BLOCK_BYTES.
+        '''
+        self._check_table(column)
+        fields = tuple(columns or ())
+        for field in fields:
+            self._check_table(field)
+        if self._monotonic and column in self._monotonic:
+            start = 0 if lo is None else self._search(column, lo, 'left')
+            stop = self._nrows() if hi is None else self._search(column, hi, 'right')
+            rows = self._read((slice(start, max(start, stop)), ), use_cache=False)
+            return _select_fields(rows, fields)
+
+        parts = []
+        region = self._region()
+        for i, block in self._iter_blocks(region, self._block_rows(region)):
+            mask = np.ones(len(block), dtype=np.bool)
+            if lo is not None:
+                mask &= block[column] >= lo
+            if hi is not None:
+                mask &= block[column] <= hi
+            parts.append(_select_fields(block[mask], fields))
+        if not parts:
+            return _select_fields(self._read((slice(0, 0), ), use_cache=False), fields)
+        return np.concatenate(parts)
+
+    def _ring_slices(self, start, stop, step=1):
+        '''
+        Return the physical slices holding logical rows start:stop:step
+        (step > 0) of a ring buffer, in order.
+        '''
+        offset = self._ring_head if self._ring_wrapped else 0
+        n = len(xrange(start, stop, step))
+        if n == 0:
+            return [slice(0, 0)]
+        pstart = (start + offset) % self._ring
+        k = min(n, -(-(self._ring - pstart) // step))
+        ret = [slice(pstart, pstart + (k - 1) * step + 1, step)]
+        if k < n:
+            pstart = (pstart + k * step) % self._ring
+            ret.append(slice(pstart, pstart + (n - k - 1) * step + 1, step))
+        return ret
+
+    def _ring_read(self, idx):
+        '''
+        Return the data at logical index <idx> of a ring buffer, oldest
+        rows first.
+        '''
+        idx = self._logical_index(idx)
+        first, rest = idx[0], idx[1:]
+        offset = self._ring_head if self._ring_wrapped else 0
+        if isinstance(first, (int, long, np.integer)):
+            return self._h5f[((first + offset) % self._ring, ) + rest]
+        if isinstance(first, slice) and first.indices(self._nrows())[2] > 0:
+            slices = self._ring_slices(*first.indices(self._nrows()))
+            parts = [self._h5f[(s, ) + rest] for s in slices]
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if first is None:
+            raise IndexError('Unsupported index for ring buffer: %r' % (idx, ))
+        if isinstance(first, slice):
+            rows = np.arange(*first.indices(self._nrows()))
+        elif first.dtype == np.bool:
+            rows = np.nonzero(first)[0]
+        else:
+            rows = first
+        phys, inverse = np.unique((rows + offset) % self._ring, return_inverse=True)
+        return self._h5f[(list(phys), ) + rest][inverse]
+
+    def _ring_write(self, idx, val):
+        '''
+        Write <val> to logical index <idx> (as returned by _logical_index())
+        of a ring buffer. Only integer and slice indices are supported.
+        '''
+        first, rest = idx[0], idx[1:]
+        if isinstance(first, (int, long, np.integer)):
+            offset = self._ring_head if self._ring_wrapped else 0
+            self._h5f[((first + offset) % self._ring, ) + rest] = val
+            return
+        if not isinstance(first, slice) or first.indices(self._nrows())[2] < 0:
+            raise IndexError('Only integer and slice indices can be used to write to a ring buffer')
+        slices = self._ring_slices(*first.indices(self._nrows()))
+        val = np.asarray(val)
+        pos = 0
+        for s in slices:
+            if len(slices) > 1 and val.ndim > 0:
+                n = len(xrange(s.start, s.stop, s.step))
+                self._h5f[(s, ) + rest] = val[pos:pos + n]
+                pos += n
+            else:
+                self._h5f[(s, ) + rest] = val
+
+    def _ring_extend(self, data):
+        '''
+        Append the rows in <data> to a ring buffer, overwriting the oldest
+        rows once it is full.
+        '''
+        if data.shape[1:] != self._h5f.shape[1:]:
+            raise ValueError('incompatible shapes %s, %s' % (self.get_shape(), data.shape))
+        cap = self._ring
+        n = data.shape[0]
+        nrows = self._nrows()
+        overwrite = self._ring_wrapped or self._ring_head + n > cap
+        if n >= cap:
+            self._h5f[0:cap] = data[-cap:]
+            self._ring_head = 0
+        else:
+            head = self._ring_head
+            first = min(n, cap - head)
+            self._h5f[head:head + first] = data[:first]
+            if first < n:
+                self._h5f[0:n - first] = data[first:]
+            self._ring_head = (head + n) % cap
+        self._ring_wrapped = self._ring_wrapped or nrows + n >= cap
+        self._ring_total += n
+        attrs = self._h5f.attrs
+        attrs[RING_HEAD_ATTR] = self._ring_head
+        attrs[RING_WRAPPED_ATTR] = self._ring_wrapped
+        attrs[RING_TOTAL_ATTR] = self._ring_total
+
+        new_nrows = self._nrows()
+        if new_nrows != nrows:
+            self._emit_resize(self.get_shape())
+        # Once rows are overwritten all logical rows shift
+        self._log_change(None if overwrite else (nrows, new_nrows))
+        self._schedule_flush(_nbytes(data))
+        self.emit_changed(_slice=slice(new_nrows - min(n, cap), new_nrows))
+
+    def _row_offset(self):
+        '''
+        Return the number of rows written before logical row 0, i.e. the
+        rows dropped from a ring buffer.
+        '''
+        if self._ring is None:
+            return 0
+        return self._ring_total - self._nrows()
+
+    def _log_change(self, rows):
+        '''
+        Bump the version and remember that <rows> (a (start, stop) range,
+        None for everything) changed.
+        '''
+        if len(self._changelog) == self._changelog.maxlen:
+            self._log_start = self._changelog[0][0]
+        self._version = dataserv._next_version()
+        self._changelog.append((self._version, rows))
+        dataserv._cache.invalidate(self._fullname, rows)
+
+    def get_version(self):
+        '''
+        Return the current version, which increases with every modification.
+        '''
+        return self._version
+
+    def read_since(self, version=0):
+        '''
+        Return the rows changed since <version> as a dict with keys:
+        - version: the current version, to pass in the next call
+        - shape: the current shape
+        - full: True if the changes since <version> are no longer known, in
+          which case 'data' contains the complete data set
+        - ranges: list of (start, stop) row ranges that changed
+        - data: list of arrays with the data of each range
+        '''
+        with dataserv._get_lock(self._fn):
+            shape = self.get_shape()
+            current, log_start = self._version, self._log_start
+            changelog = list(self._changelog)
+        ret = dict(version=current, shape=shape, full=False, ranges=[], data=[])
+        if version >= current:
+            return ret
+        ranges = []
+        if version >= log_start:
+            for v, rows in changelog:
+                if v <= version:
+                    continue
+                if rows is None:
+                    ranges = None
+                    break
+                ranges.append(rows)
+        else:
+            ranges = None
+        if ranges is None or len(shape) == 0:
+            ret.update(full=True, data=self[()])
+            return ret
+
+        # Merge overlapping ranges
+        nrows = shape[0]
+        for start, stop in sorted(ranges):
+            start, stop = min(start, nrows), min(stop, nrows)
+            if ret['ranges'] and start <= ret['ranges'][-1][1]:
+                last = ret['ranges'][-1]
+                ret['ranges'][-1] = (last[0], max(last[1], stop))
+            elif stop > start:
+                ret['ranges'].append((start, stop))
+        ret['data'] = [self[start:stop] for start, stop in ret['ranges']]
+        return ret
+
+    def get_shm(self, idx=slice(None), min_bytes=SHM_MIN_BYTES):
+        '''
+        Return self[idx] through a shared memory segment if it is at least
+        <min_bytes> large. In that case only a descriptor (name, shape,
+        dtype, offset) is returned, which a client on the same host reads
+        with dataserver_helpers.shm_read(); otherwise the data is returned
+        directly.
+        '''
+        data = self[idx]
+        if not isinstance(data, np.ndarray) or data.nbytes < min_bytes:
+            return data
+        return dataserv._shm_export(data)
+
+    def set_shm(self, idx, desc):
+        '''
+        Perform self[idx] = data, with data in the shared memory segment
+        described by <desc>, as created by dataserver_helpers.shm_write().
+        The segment is removed afterwards.
+        '''
+        self[idx] = shm_read(dataserv._shm_check(desc))
+
     def get_fullname(self):
-        return self._h5f.file.filename + self._h5f.name
+        return self._fn + self._path
 
     def emit_changed(self, _slice=None):
-        self._group.emit_changed(self._name, _slice=_slice)
+        coalescer = self._coalescer or dataserv._get_coalescer(self._group, self._group)
+        if coalescer is not None:
+            coalescer.add_changed(self._name, _row_range(_slice, self._nrows()))
+        else:
+            self._group.emit_changed(self._name, _slice=_slice)
+
+    def _emit_resize(self, shape):
+        coalescer = self._coalescer or dataserv._get_coalescer(self._group, self._group)
+        if coalescer is not None:
+            coalescer.add_resize(shape, self)
+        else:
+            _emit(self, 'resize', shape)
+
+    def set_coalesce(self, window):
+        '''
+        Coalesce 'changed' and 'resize' signals of this data set within
+        <window> ms. Merged 'changed' signals carry a slice along the first
+        axis covering all modified rows. A window of 0 disables coalescing.
+        '''
+        dataserv._set_coalescer(self, window, self._group, self)
 
     def get_dtype(self):
         return self._h5f.dtype
 
+    @_locked
     def set_attrs(self, **kwargs):
         '''
         Set HDF5 attributes.
         '''
         for k, v in kwargs.iteritems():
             self._h5f.attrs[k] = v
-        self.flush()
-        self.emit('attrs-changed', kwargs)
+        self._schedule_flush()
+        _emit(self, 'attrs-changed', kwargs)
 
     def get_attrs(self):
         '''
         Get HDF5 attributes.
         '''
-        scale_attrs = ('DIMENSION_SCALE', 'DIMENSION_LIST', 'CLASS', 'NAME', 'REFERENCE_LIST')
-        return {k:self._h5f.attrs[k] for k in self._h5f.attrs if k not in scale_attrs}
+        return {k:self._h5f.attrs[k] for k in self._h5f.attrs if k not in SCALE_ATTRS + INTERNAL_ATTRS}
 
     def get_xpts(self):
-        x0 = self._h5f.attrs['x0']
+        x0 = self._h5f.attrs['x0'] + self._h5f.attrs['xscale'] * self._row_offset()
         xscale = self._h5f.attrs['xscale']
-        npts = len(self._h5f)
+        npts = self._nrows()
         x1 = x0 + xscale * (npts - 1)
         return np.linspace(x0, x1, npts)
 
@@ -109,15 +1761,18 @@ class DataSet(object):
         return np.linspace(y0, y1, npts)
 
     def get_shape(self):
-        return self._h5f.shape
+        shape = self._h5f.shape
+        if self._length is not None or self._ring is not None:
+            shape = (self._nrows(), ) + shape[1:]
+        return shape
 
     def get_extent(self):
         """
         Return the boundaries of the dataset. (x0, x1) if rank 1. (x0, x1, y0, y1) if rank 2
         """
-        x0 = self._h5f.attrs['x0']
         xscale = self._h5f.attrs['xscale']
-        x1 = x0 + xscale*(self._h5f.shape[0] - 1)
+        x0 = self._h5f.attrs['x0'] + xscale * self._row_offset()
+        x1 = x0 + xscale*(self._nrows() - 1)
 
         if 'y0' in self._h5f.attrs:
             y0 = self._h5f.attrs['y0']
@@ -131,42 +1786,407 @@ class DataSet(object):
         """
         Use the current dataset shape to infer the scale parameter given the boundaries
         """
-        xscale = (x1 - x0) / (self._h5f.shape[0] - 1)
+        xscale = (x1 - x0) / (self._nrows() - 1)
         self.set_attrs(x0=x0, x1=x1, xscale=xscale)
         if y0 is not None:
             yscale = (y1 - y0) / (self._h5f.shape[1] - 1)
         self.set_attrs(y0=y0, y1=y1, yscale=yscale)
 
+    @_locked
     def extend(self, data):
-        data = np.array(data)
-        old_shape = self._h5f.shape
-        new_shape = list(self._h5f.shape)
-        new_shape[0] += data.shape[0]
+        '''
+        Append the rows in <data> along axis 0.
+
+        The data set is over-allocated geometrically (by GROWTH_FACTOR,
+        rounded to whole chunks) so that appending is amortized O(1), except
+        in SWMR mode, where readers see the allocated shape. Ring buffers
+        are never resized; the oldest rows are overwritten instead. Rows of
+        a table can be given in any form append_rows() accepts.
+        '''
+        if self._h5f.dtype.names is not None:
+            data = self._table_rows(data)
+            self._update_monotonic(data)
+        else:
+            data = np.array(data)
+        if self._ring is not None:
+            return self._ring_extend(data)
+        nrows = self._nrows()
+        alloc_shape = list(self._h5f.shape)
+        new_shape = [nrows + data.shape[0]] + alloc_shape[1:]
 
         if len(new_shape) > 1 and new_shape[1] == 0:
             for i, s in enumerate(data.shape[1:]):
                 new_shape[i+1] = s
 
         assert all(i == j for i, j in zip(new_shape[1:], data.shape[1:])), \
-            "incompatible shapes %s, %s" % (self._h5f.shape, data.shape)
+            "incompatible shapes %s, %s" % (self.get_shape(), data.shape)
 
-        self._h5f.resize(new_shape)
-        self.emit("resize", new_shape)
+        if new_shape[0] > alloc_shape[0] or new_shape[1:] != alloc_shape[1:]:
+            alloc_shape = [self._grow_rows(new_shape[0])] + new_shape[1:]
+            self._h5f.resize(alloc_shape)
+        self._set_length(new_shape[0])
+        self._emit_resize(new_shape)
 
-        self[old_shape[0]:new_shape[0]] = data
+        self._write(slice(nrows, new_shape[0]), data)
+
+    def _grow_rows(self, nrows):
+        '''
+        Return the number of rows to allocate to hold at least <nrows>.
+        '''
+        if getattr(self._h5f.file, 'swmr_mode', False):
+            return nrows
+        allocated = self._h5f.shape[0]
+        chunk = self._h5f.chunks[0] if self._h5f.chunks else 1
+        rows = max(nrows, int(allocated * GROWTH_FACTOR), allocated + chunk)
+        rows = -(-rows // chunk) * chunk
+        maxrows = self._h5f.maxshape[0]
+        if maxrows is not None:
+            rows = min(rows, maxrows)
+        return rows
+
+    def _set_length(self, nrows):
+        if self._length is None and nrows == self._h5f.shape[0]:
+            return
+        self._length = nrows
+        self._h5f.attrs[LENGTH_ATTR] = nrows
+        dataserv._add_overallocated(self._h5f)
+
+    def _trim(self):
+        _trim_dataset(self._h5f)
+        self._length = None
 
     def append(self, data):
         self.extend([data])
 
+    def _region(self, _slice=None):
+        '''
+        Normalize <_slice> (None, a slice or a sequence of slices) to a
+        tuple of (start, stop, step) for every axis of the data set.
+        '''
+        shape = self.get_shape()
+        if _slice is None:
+            _slice = ()
+        elif not isinstance(_slice, (tuple, list)):
+            _slice = (_slice, )
+        if len(_slice) > len(shape):
+            raise IndexError('Too many indices for data set of rank %d' % len(shape))
+        region = []
+        for i, n in enumerate(shape):
+            s = _slice[i] if i < len(_slice) else slice(None)
+            if not isinstance(s, slice):
+                raise ValueError('Only slices are supported, got %r' % (s, ))
+            start, stop, step = s.indices(n)
+            if step < 0:
+                raise ValueError('Negative steps are not supported')
+            region.append((start, max(start, stop), step))
+        return tuple(region)
+
+    def _block_rows(self, region, multiple=1):
+        '''
+        Return the number of rows (along axis 0) to read at once from
+        <region>, a multiple of <multiple> and about READ_BLOCK_BYTES large.
+        '''
+        rowsize = self._h5f.dtype.itemsize
+        for start, stop, step in region[1:]:
+            rowsize *= len(xrange(start, stop, step))
+        rows = max(1, READ_BLOCK_BYTES // max(rowsize, 1))
+        return max(multiple, rows // multiple * multiple)
+
+    def _iter_blocks(self, region, rows):
+        '''
+        Iterate over <region> in blocks of <rows> rows, yielding the row
+        offset within the region and the data.
+        '''
+        start, stop, step = region[0]
+        rest = tuple(slice(*r) for r in region[1:])
+        n = len(xrange(start, stop, step))
+        for i in xrange(0, n, rows):
+            last = start + (min(i + rows, n) - 1) * step
+            yield i, self._read((slice(start + i * step, last + 1, step), ) + rest, use_cache=False)
+
+    def get_chunk_ranges(self, axis=0, rows_per_chunk=None, _slice=None):
+        '''
+        Split self[_slice] into blocks along <axis> to be read one by one
+        with read_block(), see dataserver_helpers.iter_chunks().
+
+        Blocks contain <rows_per_chunk> rows along <axis>, or about
+        READ_BLOCK_BYTES if None. For contiguous slices of a chunked data
+        set the blocks are aligned to, and a multiple of, the HDF5 chunks
+        so that every chunk is read only once.
+
+        Returns a list of tuples with a slice for every axis.
+        '''
+        region = self._region(_slice)
+        if not 0 <= axis < len(region):
+            raise ValueError('Invalid axis %d for data set of rank %d' % (axis, len(region)))
+        start, stop, step = region[axis]
+        if rows_per_chunk is None:
+            rowsize = self._h5f.dtype.itemsize
+            for i, r in enumerate(region):
+                if i != axis:
+                    rowsize *= len(xrange(*r))
+            rows_per_chunk = max(1, READ_BLOCK_BYTES // max(rowsize, 1))
+        rows_per_chunk = max(1, int(rows_per_chunk))
+
+        chunks = self._h5f.chunks
+        if chunks and step == 1 and rows_per_chunk >= chunks[axis]:
+            align = rows_per_chunk // chunks[axis] * chunks[axis]
+        else:
+            align = None
+        ret = []
+        pos = start
+        while pos < stop:
+            if align:
+                end = min(stop, (pos // align + 1) * align)
+            else:
+                end = min(stop, pos + rows_per_chunk * step)
+            block = [slice(*r) for r in region]
+            block[axis] = slice(pos, end, step)
+            ret.append(tuple(block))
+            pos = end
+        return ret
+
+    def submit(self, method, *args, **kwargs):
+        '''
+        Call <method> with <args> and <kwargs> on an I/O thread and return
+        a PendingResult immediately, see DataServer.submit().
+        '''
+        return _submit(self, method, args, kwargs)
+
+    def subscribe(self, keys=None, signals=None, min_interval=0,
+                  maxlen=SUBSCRIPTION_QUEUE, policy=OVERFLOW_DROP_OLDEST):
+        '''
+        Return a Subscription to the signals of this object, optionally
+        restricted to children <keys> and signal names <signals>.
+        '''
+        return Subscription(self, keys, signals, min_interval, maxlen, policy)
+
+    def read_block(self, block, min_bytes=None):
+        '''
+        Return self[block], bypassing the slice cache. If <min_bytes> is
+        given and the data is at least that large, it is returned through
+        shared memory, as get_shm() does.
+        '''
+        data = self._read(tuple(block), use_cache=False)
+        if min_bytes is None or not isinstance(data, np.ndarray) or data.nbytes < min_bytes:
+            return data
+        return dataserv._shm_export(data)
+
+    def _axis_coords(self, axis, idx):
+        '''
+        Return the coordinates for (fractional) indices <idx> along <axis>,
+        as get_xpts() and get_ypts() do. Without scale attributes the
+        indices (counting rows dropped from a ring buffer) are returned.
+        '''
+        name = 'xy'[axis] if axis < 2 else None
+        if axis == 0:
+            idx = np.asarray(idx) + self._row_offset()
+        attrs = self._h5f.attrs
+        if name is None or (name + '0') not in attrs or (name + 'scale') not in attrs:
+            return np.asarray(idx, dtype=np.float64)
+        return attrs[name + '0'] + attrs[name + 'scale'] * np.asarray(idx, dtype=np.float64)
+
+    def get_decimated(self, _slice=None, max_points=2000, method=DECIMATE_STRIDE):
+        '''
+        Return a reduced version of self[_slice] with at most <max_points>
+        points along every axis (or max_points[i] along axis i).
+
+        <method> is one of:
+        - DECIMATE_STRIDE: pick every n-th point
+        - DECIMATE_MINMAX: the min/max envelope of every bin
+        - DECIMATE_MEAN: the mean of every bin
+
+        The data is read in blocks of at most READ_BLOCK_BYTES. Returns a
+        dict with coordinates 'x' (and 'y' for 2D data, matching get_xpts()
+        and get_ypts()) and 'data', or 'min' and 'max' for DECIMATE_MINMAX.
+        '''
+        if method not in DECIMATE_METHODS:
+            raise ValueError('Unknown decimation method %r, expected one of %s' % (method, DECIMATE_METHODS))
+        region = self._region(_slice)
+        if len(region) == 0:
+            raise ValueError('Unable to decimate scalar data set')
+        if not isinstance(max_points, (tuple, list)):
+            max_points = (max_points, ) * len(region)
+        lens = [len(xrange(*r)) for r in region]
+        bins = [max(1, -(-n // max(m, 1))) for n, m in zip(lens, max_points)]
+
+        ret = {}
+        for axis, ((start, stop, step), n, b) in enumerate(zip(region, lens, bins)[:2]):
+            first = np.arange(0, n, b)
+            if method == DECIMATE_STRIDE:
+                idx = first
+            else:
+                idx = (first + np.minimum(first + b, n) - 1) / 2.0
+            ret['xy'[axis]] = self._axis_coords(axis, start + step * idx)
+
+        if method == DECIMATE_STRIDE or 0 in lens:
+            data = self[tuple(slice(start, stop, step * b) for (start, stop, step), b in zip(region, bins))]
+            if method == DECIMATE_MINMAX:
+                ret['min'], ret['max'] = data, data
+            else:
+                ret['data'] = data
+            return ret
+
+        if method == DECIMATE_MINMAX:
+            ufuncs = (np.minimum, np.maximum)
+        else:
+            ufuncs = (np.add, )
+        results = [[] for u in ufuncs]
+        counts = []
+        rows = self._block_rows(region, multiple=bins[0])
+        for i, block in self._iter_blocks(region, rows):
+            for res, ufunc in zip(results, ufuncs):
+                res.append(_bin_reduce(ufunc, block, bins))
+            if method == DECIMATE_MEAN:
+                counts.append(_bin_reduce(np.add, np.ones(block.shape), bins))
+        results = [np.concatenate(res) for res in results]
+
+        if method == DECIMATE_MINMAX:
+            ret['min'], ret['max'] = results
+        else:
+            ret['data'] = results[0] / np.concatenate(counts)
+        return ret
+
+    def _cached_reduction(self, key, func):
+        '''
+        Return func(), cached under <key> as long as the data set is not
+        modified.
+        '''
+        hit = self._reduced.get(key, None)
+        if hit is not None and hit[0] == self._version:
+            return hit[1]
+        ret = func()
+        self._reduced[key] = (self._version, ret)
+        while len(self._reduced) > REDUCE_CACHE_LENGTH:
+            self._reduced.popitem(last=False)
+        return ret
+
+    def reduce(self, op, axis=None, _slice=None):
+        '''
+        Return the reduction <op> (one of REDUCE_OPS) of self[_slice] along
+        <axis>, or over all elements if axis is None.
+
+        The data is read in blocks of about READ_BLOCK_BYTES and partial
+        results are combined (using a pairwise update for mean and
+        variance), so memory use is bounded by the block size.
+        '''
+        if op not in REDUCE_OPS:
+            raise ValueError('Unknown reduction %r, expected one of %s' % (op, REDUCE_OPS))
+        region = self._region(_slice)
+        if len(region) == 0:
+            raise ValueError('Unable to reduce scalar data set')
+        if axis is not None and not 0 <= axis < len(region):
+            raise ValueError('Invalid axis %d for data set of rank %d' % (axis, len(region)))
+        return self._cached_reduction(('reduce', op, axis, region),
+                                      lambda: self._reduce(op, axis, region))
+
+    def _reduce(self, op, axis, region):
+        if op in ('min', 'max'):
+            ufunc = np.minimum if op == 'min' else np.maximum
+            parts = [ufunc.reduce(block, axis=axis) for i, block in
+                     self._iter_blocks(region, self._block_rows(region)) if block.size]
+            if not parts:
+                raise ValueError('Unable to compute %s of empty selection' % (op, ))
+            if axis is None or axis == 0:
+                return reduce(ufunc, parts)
+            return np.concatenate(parts)
+
+        # Count, sum and sum of squared deviations, merged per block
+        result = None
+        parts = []
+        for i, block in self._iter_blocks(region, self._block_rows(region)):
+            n = block.size if axis is None else block.shape[axis]
+            if n == 0:
+                continue
+            total = block.sum(axis=axis)
+            m2 = None
+            if op in ('var', 'std'):
+                mean = total / float(n)
+                dev = block - (mean if axis is None else np.expand_dims(mean, axis))
+                m2 = (np.abs(dev) ** 2).sum(axis=axis)
+            part = [n, total, m2]
+            if axis is not None and axis != 0:
+                parts.append(part)
+            elif result is None:
+                result = part
+            else:
+                n0, total0, m20 = result
+                if m2 is not None:
+                    delta = total / float(n) - total0 / float(n0)
+                    result[2] = m20 + m2 + np.abs(delta) ** 2 * (float(n0) * n / (n0 + n))
+                result[0] = n0 + n
+                result[1] = total0 + total
+        if parts:
+            result = [parts[0][0]] + [None if p[0] is None else np.concatenate(p)
+                                      for p in zip(*parts)[1:]]
+        if result is None:
+            if op in ('sum', 'count'):
+                return 0
+            raise ValueError('Unable to compute %s of empty selection' % (op, ))
+
+        n, total, m2 = result
+        if op == 'count':
+            return n
+        elif op == 'sum':
+            return total
+        elif op == 'mean':
+            return total / float(n)
+        elif op == 'var':
+            return m2 / n
+        return np.sqrt(m2 / n)
+
+    def histogram(self, bins=10, range=None, _slice=None):
+        '''
+        Return the histogram of self[_slice] as a dict with 'counts' and
+        'edges', see numpy.histogram(). If <range> is not given, it is the
+        (NaN-ignoring) minimum and maximum of the data, which takes an
+        extra pass. Non-finite values are not counted.
+
+        The data is read in blocks of about READ_BLOCK_BYTES.
+        '''
+        region = self._region(_slice)
+        if isinstance(bins, (list, tuple, np.ndarray)):
+            bins = tuple(bins)
+        if range is not None:
+            range = tuple(range)
+        return self._cached_reduction(('histogram', bins, range, region),
+                                      lambda: self._histogram(bins, range, region))
+
+    def _histogram(self, bins, range, region):
+        rows = self._block_rows(region)
+        if range is None and not isinstance(bins, tuple):
+            lo, hi = np.inf, -np.inf
+            for i, block in self._iter_blocks(region, rows):
+                block = block[np.isfinite(block)]
+                if block.size:
+                    lo, hi = min(lo, block.min()), max(hi, block.max())
+            if lo > hi:
+                lo, hi = 0, 1
+            range = (lo, hi)
+        counts, edges = np.histogram([], bins=bins, range=range)
+        for i, block in self._iter_blocks(region, rows):
+            block = block[np.isfinite(block)]
+            counts += np.histogram(block, bins=edges)[0]
+        return dict(counts=counts, edges=edges)
+
     def flush(self):
-        self._h5f.file.flush()
+        '''
+        Flush the file containing this data set now.
+        '''
+        dataserv.flush_now(self._fn)
+
+    def _schedule_flush(self, nbytes=0):
+        dataserv._get_flusher(self._fn).written(nbytes)
 
     def release(self):
+        dataserv._set_coalescer(self, 0, None)
+        dataserv._cache.invalidate(self._fullname)
         dataserv._unregister(self.get_fullname())
         logging.debug('Released %s, %d data objects left', self.get_fullname(), len(dataserv._datagroups))
         self._h5f = None
         self._group = None
 
+@_exposed
 class DataGroup(object):
     '''
     Shareable wrapper for HDF5 data group objects.
@@ -174,17 +2194,28 @@ class DataGroup(object):
     Can be indexed to get sub-groups or sets.
     '''
 
+    _h5f = _h5f_property()
+
     def __init__(self, h5f):
         self._h5f = h5f
-        dataserv._register(self.get_fullname(), self)
+        self._atime = time.time()
+        self._coalescer = None
+        self._subscriptions = []
+        self._max_child = None
+        dataserv._register(self)
+
+    def _rebind(self, h5f):
+        self._h5f = h5f
 
     def __getitem__(self, key):
         val = self._h5f[key]
 
         # See if this object has a proxy already
         fullname = val.file.filename + val.name
-        if fullname in dataserv._datagroups:
-            return dataserv._datagroups[fullname]
+        proxy = dataserv._datagroups.get(fullname, None)
+        if proxy is not None:
+            proxy._atime = time.time()
+            return proxy
 
         # Create a proxy
         if isinstance(val, h5py.Group):
@@ -196,64 +2227,208 @@ class DataGroup(object):
 
         return val
 
+    @_locked
     def __setitem__(self, key, val):
         if isinstance(val, list):
             val = np.array(val)
         if key in self._h5f and isinstance(val, np.ndarray):
-            if val.shape != self._h5f[key].shape:
-                attrs = dict(self._h5f[key].attrs)
+            h5f = self._h5f[key]
+            if RING_ATTR in h5f.attrs:
+                # The head pointer and wrap state describe the stored rows,
+                # which a whole-array write would silently invalidate.
+                raise ValueError('Cannot replace ring buffer %s, delete it first' % (h5f.name, ))
+            if val.shape == h5f.shape and LENGTH_ATTR not in h5f.attrs:
+                h5f[:] = val
+            elif not self._resize_child(h5f, val):
+                # Over-allocation does not carry over to the new data set
+                attrs = dict(h5f.attrs)
+                attrs.pop(LENGTH_ATTR, None)
+                dataserv._remove_overallocated(self._fn, h5f.name)
                 del self._h5f[key]
-                self._h5f[key] = val
-                fullname = self._h5f.file.filename + self._h5f[key].name
-                if fullname in dataserv._datagroups:
-                    dataserv._datagroups[fullname]._h5f = self._h5f[key]
+                self._create_child(key, val)
                 for k, v in attrs.items():
                     self._h5f[key].attrs[k] = v
-            else:
-                self._h5f[key][:] = val
+            self._child_replaced(key, val)
+        elif isinstance(val, np.ndarray):
+            self._create_child(key, val)
         elif isinstance(val, DataSet):
             self._h5f[key] = val._h5f
         else:
             self._h5f[key] = val
-        self.flush()
+        self._child_added(key)
+        self._child_changed(key)
+        self._schedule_flush(_nbytes(val))
         self.emit_changed(key)
 
+    def _create_child(self, key, val):
+        '''
+        Create data set <key> holding array <val>. Unless it is a scalar or
+        RESIZABLE is False, it is chunked with an unlimited maximum shape.
+        '''
+        maxshape = None
+        if RESIZABLE and val.ndim > 0:
+            maxshape = (None, ) * val.ndim
+        opts = storage_options(val.shape, val.dtype, self._inherited_attr(POLICY_ATTR),
+                               self._inherited_attr(ACCESS_ATTR), maxshape)
+        return self._h5f.create_dataset(key, data=val, maxshape=maxshape, **opts)
+
+    def _resize_child(self, h5f, val):
+        '''
+        Resize HDF5 data set <h5f> to the shape of <val> and store <val> in
+        it, which also ends over-allocation. Returns False if that is not
+        possible because the data type or rank differs or the data set is
+        not resizable.
+        '''
+        if h5f.dtype != val.dtype or len(h5f.shape) != val.ndim or h5f.chunks is None:
+            return False
+        if RING_ATTR in h5f.attrs:
+            return False
+        if any(m is not None and m < n for m, n in zip(h5f.maxshape, val.shape)):
+            return False
+        h5f.resize(val.shape)
+        if val.size:
+            h5f[...] = val
+        if LENGTH_ATTR in h5f.attrs:
+            del h5f.attrs[LENGTH_ATTR]
+            dataserv._remove_overallocated(h5f.file.filename, h5f.name)
+        return True
+
+    def _child_replaced(self, key, val):
+        '''
+        Update data set <key> after its data was replaced by array <val>:
+        recompute the monotonic columns if it is a table (otherwise drop
+        them) and rebind its proxy, if any.
+        '''
+        h5f = self._h5f[key]
+        if MONOTONIC_ATTR in h5f.attrs:
+            if h5f.dtype.names is not None and len(h5f.shape) == 1:
+                h5f.attrs[MONOTONIC_ATTR] = ','.join(_monotonic_columns(h5f.dtype, h5f[...]))
+            else:
+                del h5f.attrs[MONOTONIC_ATTR]
+        proxy = dataserv._datagroups.get(self._child_fullname(key), None)
+        if proxy is not None:
+            proxy._rebind(h5f)
+
+    def _child_fullname(self, key):
+        return self._fn + posixpath.join(self._path, key)
+
+    def _child_changed(self, key):
+        '''
+        Notify the proxy of child <key>, if any, that it was modified directly.
+        '''
+        fullname = self._child_fullname(key)
+        dataserv._cache.invalidate_tree(fullname)
+        ds = dataserv._datagroups.get(fullname, None)
+        if isinstance(ds, DataSet):
+            ds._log_change(None)
+
+    @_locked
     def __delitem__(self, key):
+        self._child_changed(key)
+        dataserv._unregister_tree(self._child_fullname(key))
         del self._h5f[key]
-        self.flush()
-        self.emit('removed', key)
+        self._child_removed(key)
+        self._schedule_flush()
+        _emit(self, 'removed', key)
 
     def __contains__(self, item):
         return item in self._h5f
 
     def get_fullname(self):
-        return self._h5f.file.filename + self._h5f.name
+        return self._fn + self._path
+
+    def _child_number(self, name):
+        '''
+        Return the number of child <name>, or None if it is not numeric.
+        '''
+        try:
+            return int(name)
+        except ValueError:
+            return None
 
+    def _path_groups(self, key):
+        '''
+        Return the registered DataGroup proxies along path <key>, relative
+        to this group, as (proxy, name of its child on the path) tuples.
+        '''
+        path = '/' if key.startswith('/') else self._path
+        ret = []
+        for name in key.strip('/').split('/'):
+            proxy = dataserv._datagroups.get(self._fn + path, None)
+            if isinstance(proxy, DataGroup):
+                ret.append((proxy, name))
+            path = posixpath.join(path, name)
+        return ret
+
+    def _child_added(self, key):
+        '''
+        Update the numbered child index after adding <key>. As intermediate
+        groups are created too, the index of every registered group along
+        the path is updated.
+        '''
+        for proxy, name in self._path_groups(key):
+            n = self._child_number(name)
+            if n is not None and proxy._max_child is not None:
+                proxy._max_child = max(n, proxy._max_child)
+
+    def _child_removed(self, key):
+        '''
+        Update the numbered child index of the parent of removed <key>.
+        '''
+        path = posixpath.join(self._path, key.rstrip('/'))
+        proxy = dataserv._datagroups.get(self._fn + posixpath.dirname(path), None)
+        if isinstance(proxy, DataGroup) and self._child_number(posixpath.basename(path)) == proxy._max_child:
+            proxy._max_child = None     # Re-index on next use
+
+    @_locked
     def get_numbered_child(self):
-        max_n = 0
-        for k in self.keys():
-            try:
-                n = int(k)
-                max_n = max(n, max_n)
-            except ValueError:
-                pass
-        return self.create_group(str(max_n+1))
+        '''
+        Create and return a new sub group named one higher than the highest
+        numbered child. The highest number is indexed on first use, and
+        again if the next number turns out to be taken.
+        '''
+        if self._max_child is None or str(self._max_child + 1) in self._h5f:
+            self._max_child = 0
+            for k in self.keys():
+                n = self._child_number(k)
+                if n is not None:
+                    self._max_child = max(n, self._max_child)
+        return self.create_group(str(self._max_child + 1))
 
     def emit_changed(self, key=None, _slice=None):
         '''
         Emit changed signal through objectsharer.
         '''
-        self.emit('changed', key, _slice)
+        coalescer = dataserv._get_coalescer(self, self)
+        if coalescer is not None:
+            rows = None
+            if _slice is not None and key in self._h5f:
+                rows = _row_range(_slice, _len(self._h5f[key].shape))
+            coalescer.add_changed(key, rows)
+        else:
+            _emit(self, 'changed', key, _slice)
+
+    def set_coalesce(self, window):
+        '''
+        Coalesce 'changed' signals for the children of this group, and the
+        'resize' signals of child data sets without their own coalescing,
+        within <window> ms. Merged 'changed' signals carry a slice along the
+        first axis covering all modified rows, 'resize' only the final
+        shape. A window of 0 disables coalescing.
+        '''
+        dataserv._set_coalescer(self, window, self)
 
+    @_locked
     def create_group(self, key):
         '''
         Create a new sub group.
         '''
         g = self._h5f.create_group(key)
+        self._child_added(key)
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
         g.attrs['timestamp'] = timestamp
-        self.flush()
-        self.emit('group-added', key)
+        self._schedule_flush()
+        _emit(self, 'group-added', key)
         return DataGroup(g)
 
     def get_group(self, key):
@@ -262,43 +2437,161 @@ class DataGroup(object):
         else:
             return self.create_group(key)
 
-    def create_dataset(self, name, shape=None, dtype=None, data=None, rank=None, **kwargs):
+    @_locked
+    def create_dataset(self, name, shape=None, dtype=None, data=None, rank=None,
+            policy=None, access=None, chunks=None, compression=None,
+            compression_opts=None, shuffle=None, ring=None, **kwargs):
         '''
         Create a new dataset and return it.
+
+        A data type with named fields (a numpy dtype or a list of (name,
+        type) pairs) creates a table, to be extended with append_rows() and
+        searched with query(); without shape or data it starts empty.
+
+        If <ring> is given, a ring buffer holding the last <ring> rows is
+        created: rows are added with append() and extend(), which overwrite
+        the oldest rows once it is full, and reading returns the rows
+        oldest first. The shape of a row is taken from <data> or <shape>.
+
+        Chunking and compression follow storage policy <policy> (see
+        STORAGE_POLICIES) and access pattern <access> (one of
+        ACCESS_PATTERNS). If not given they are taken from the POLICY_ATTR
+        and ACCESS_ATTR attributes of this group or its parents, or else the
+        configured defaults. <chunks>, <compression>, <compression_opts>
+        and <shuffle> override the policy.
+
+        Other keyword arguments are stored as attributes.
         '''
 
         if type(name) not in (str, unicode):
             raise Exception('Invalid dataset name')
-
+        if data is not None:
+            data = np.asarray(data)
+        if isinstance(dtype, list):
+            # Compound data type, as a list of (name, type) pairs
+            dtype = np.dtype([tuple(field) for field in dtype])
+        table = False
+        if dtype is not None and np.dtype(dtype).names is not None:
+            table = True
+            if shape is None and data is None and rank is None:
+                rank = 1
+        elif data is not None and data.dtype.names is not None:
+            table = True
+
+        if isinstance(shape, (int, long, np.integer)):
+            shape = (int(shape), )
         maxshape = None
-        if rank is not None:
+        if ring is not None:
+            if data is not None:
+                shape = (ring, ) + data.shape[1:]
+                dtype = dtype or data.dtype
+            else:
+                shape = (ring, ) + tuple(shape[1:] if shape is not None else ())
+            ring_data, data = data, None
+        elif rank is not None:
             maxshape = (None,) * rank
             if shape is None:
                 shape = (0,) * rank
+        elif RESIZABLE:
+            ndim = data.ndim if data is not None else len(shape or ())
+            if ndim > 0:
+                maxshape = (None,) * ndim
 
         if data is not None and dtype is not None:
             if data.dtype in COMPLEX_TYPES and dtype not in COMPLEX_TYPES:
                 raise ValueError('Trying to store complex data in real data set')
 
-        ds = self._h5f.create_dataset(name, shape=shape, dtype=dtype, data=data, maxshape=maxshape)
+        if policy is None:
+            policy = self._inherited_attr(POLICY_ATTR)
+        if access is None:
+            access = self._inherited_attr(ACCESS_ATTR)
+        if data is not None:
+            opts = storage_options(data.shape, data.dtype, policy, access, maxshape)
+        elif shape is not None:
+            opts = storage_options(shape, dtype or 'f4', policy, access, maxshape)
+        else:
+            opts = {}
+        for k, v in (('chunks', chunks), ('compression', compression),
+                     ('compression_opts', compression_opts), ('shuffle', shuffle)):
+            if v is not None:
+                opts[k] = v
+
+        ds = self._h5f.create_dataset(name, shape=shape, dtype=dtype, data=data, maxshape=maxshape, **opts)
+        if ring is not None:
+            ds.attrs[RING_ATTR] = ring
+            ds.attrs[RING_HEAD_ATTR] = 0
+            ds.attrs[RING_WRAPPED_ATTR] = False
+            ds.attrs[RING_TOTAL_ATTR] = 0
+        self._child_added(name)
         ds = DataSet(ds, self)
-        ds.set_attrs(**kwargs)      # This will flush
+        if table and len(ds.get_shape()) == 1 and ring is None:
+            ds._set_monotonic(_monotonic_columns(ds._h5f.dtype, data))
+        if ring is not None and ring_data is not None:
+            ds.extend(ring_data)
+        ds.set_attrs(**kwargs)      # This will schedule a flush
         return ds
 
+    def _inherited_attr(self, name):
+        '''
+        Return attribute <name> of this group or its closest parent that has
+        it, or None.
+        '''
+        g = self._h5f
+        while name not in g.attrs:
+            if g.name == '/':
+                return None
+            g = g.parent
+        return str(g.attrs[name])
+
     def keys(self):
         '''
         Return the available sub-groups and sets.
         '''
         return self._h5f.keys()
 
+    def submit(self, method, *args, **kwargs):
+        '''
+        Call <method> with <args> and <kwargs> on an I/O thread and return
+        a PendingResult immediately, see DataServer.submit().
+        '''
+        return _submit(self, method, args, kwargs)
+
+    def subscribe(self, keys=None, signals=None, min_interval=0,
+                  maxlen=SUBSCRIPTION_QUEUE, policy=OVERFLOW_DROP_OLDEST):
+        '''
+        Return a Subscription to the signals of this object, optionally
+        restricted to children <keys> and signal names <signals>.
+        '''
+        return Subscription(self, keys, signals, min_interval, maxlen, policy)
+
+    def get_tree(self, depth=None, include_attrs=True):
+        '''
+        Return a snapshot of the hierarchy below this group in one call,
+        without creating proxies for the nodes visited.
+
+        Every node is a dict with 'name', 'type' ('group', 'dataset' or
+        'link' for unresolvable links) and, if <include_attrs> is True,
+        'attrs' (without the dimension scale attributes). Data sets also
+        have 'shape', 'dtype' and 'chunks'; groups have 'children', or
+        'nchildren' when <depth> levels have been descended.
+        '''
+        return _node_tree(self._h5f, depth, include_attrs)
+
     def flush(self):
-        self._h5f.file.flush()
+        '''
+        Flush the file containing this group now.
+        '''
+        dataserv.flush_now(self._fn)
+
+    def _schedule_flush(self, nbytes=0):
+        dataserv._get_flusher(self._fn).written(nbytes)
 
+    @_locked
     def set_attrs(self, **kwargs):
         for k, v in kwargs.iteritems():
             self._h5f.attrs[k] = v
-        self.flush()
-        self.emit('attrs-changed', kwargs)
+        self._schedule_flush()
+        _emit(self, 'attrs-changed', kwargs)
 
     def get_attrs(self):
         ret = {}
@@ -307,8 +2600,9 @@ class DataGroup(object):
         return ret
 
     def close(self):
-        dataserv.remove_file(self._h5f.file.filename)
+        dataserv.remove_file(self._fn)
 
+    @_locked
     def set_scale(self, xname, yname, dim=0, label=None):
         if label is None:
             label = xname
@@ -316,23 +2610,164 @@ class DataGroup(object):
         self._h5f[yname].dims[dim].attach_scale(self._h5f[xname])
 
     def release(self):
+        dataserv._set_coalescer(self, 0, None)
         dataserv._unregister(self.get_fullname())
         self._h5f = None
 
-def check_backup(fn):
-    if not os.path.exists(fn):
-        return
+def backup_filename(fn):
+    '''
+    Return the name of today's backup of file <fn>.
+    '''
     datestr = time.strftime("_%Y%m%d") + '.h5'
     path_minus_drive = os.path.splitdrive(fn)[1]
     relpath_minus_drive = path_minus_drive[1:] # Remove initial slash
     relpath_with_datestr = relpath_minus_drive.split('.h5')[0] + datestr + '.h5'
-    backup_file = os.path.join(BACKUP_DIR, relpath_with_datestr)
+    return os.path.join(BACKUP_DIR, relpath_with_datestr)
+
+def check_backup(fn):
+    '''
+    Synchronously make today's backup of file <fn> if it does not exist yet.
+    The data server uses the BackupService instead.
+    '''
+    if not os.path.exists(fn):
+        return
+    backup_file = backup_filename(fn)
     if not os.path.exists(backup_file):
         dirname = os.path.dirname(backup_file)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
         copyfile(fn, backup_file)
 
+class BackupService(object):
+    '''
+    Makes daily backups of data files in a background thread.
+
+    Which files were backed up today is kept in memory, so request() is
+    cheap. Files are copied in blocks of BACKUP_BLOCK bytes at no more than
+    BACKUP_RATE bytes/s. Open files are flushed first; the copy is only
+    accepted if the file was not written to while copying. After
+    BACKUP_RETRIES attempts the file is copied at full speed with writes
+    blocked, for at most BACKUP_LOCK_TIME seconds; if that is not enough
+    the backup fails and is retried when the file is next requested.
+    '''
+
+    def __init__(self, server):
+        self._server = server
+        self._queue = Queue.Queue()
+        self._requested = set()
+        self._status = {}
+        self._thread = None
+
+    def request(self, fn):
+        '''
+        Queue today's backup of file <fn>, unless already done or queued
+        or backups are disabled.
+        '''
+        if not BACKUP_DIR:
+            return
+        key = (fn, time.strftime('%Y%m%d'))
+        if key in self._requested:
+            return
+        self._requested.add(key)
+        self._status[fn] = dict(state='queued', backup_file=None, size=0, copied=0, error=None)
+        self._queue.put(key)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='backup')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def get_status(self, fn=None):
+        if fn is not None:
+            return self._status.get(fn, None)
+        return self._status
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            fn = key[0]
+            status = self._status[fn]
+            try:
+                self._backup(fn, status)
+            except Exception, e:
+                logging.warning('Backup of %s failed: %s', fn, e)
+                status.update(state='failed', error=str(e))
+                self._requested.discard(key)
+
+    def _backup(self, fn, status):
+        if not os.path.exists(fn):
+            # Nothing to back up yet, try again on the next request
+            status['state'] = 'skipped'
+            self._requested.discard((fn, time.strftime('%Y%m%d')))
+            return
+        backup_file = backup_filename(fn)
+        status['backup_file'] = backup_file
+        if os.path.exists(backup_file):
+            status['state'] = 'done'
+            return
+        dirname = os.path.dirname(backup_file)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmpfile = backup_file + '.partial'
+        status['state'] = 'copying'
+        for attempt in range(BACKUP_RETRIES):
+            nwrites = self._server._snapshot(fn)
+            self._copy(fn, tmpfile, status, BACKUP_RATE)
+            if self._server._snapshot(fn) == nwrites:
+                break
+            logging.info('%s modified during backup, retrying', fn)
+        else:
+            with self._server._get_lock(fn):
+                self._server._snapshot(fn)
+                done = self._copy(fn, tmpfile, status, None, time.time() + BACKUP_LOCK_TIME)
+            if not done:
+                os.remove(tmpfile)
+                raise Exception('file modified during every attempt and too large to copy with writes blocked')
+        os.rename(tmpfile, backup_file)
+        status['state'] = 'done'
+
+    def _copy(self, src, dst, status, rate, deadline=None):
+        '''
+        Copy <src> to <dst> in blocks, limited to <rate> bytes/s. Returns
+        False if the copy was abandoned because it did not finish before
+        time <deadline>.
+        '''
+        status['size'] = os.path.getsize(src)
+        status['copied'] = 0
+        start = time.time()
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                while True:
+                    if deadline is not None and time.time() > deadline:
+                        return False
+                    buf = fsrc.read(BACKUP_BLOCK)
+                    if not buf:
+                        break
+                    fdst.write(buf)
+                    status['copied'] += len(buf)
+                    if rate:
+                        delay = status['copied'] / float(rate) - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+        return True
+
+class BatchError(Exception):
+    '''
+    Raised by DataServer.batch() when operation <index> (calling <method>)
+    raised <error>.
+    '''
+
+    def __init__(self, index, method, error):
+        Exception.__init__(self, index, method, error)
+        self.index = index
+        self.method = method
+        self.error = error
+
+    def __str__(self):
+        return 'Batch operation %d (%s) failed: %s: %s' % \
+            (self.index, self.method, type(self.error).__name__, self.error)
+
+@_exposed
 class DataServer(object):
     '''
     Shared data server.
@@ -342,42 +2777,368 @@ class DataServer(object):
 
     def __init__(self):
         self._hdf5_files = {}
-        self._datagroups = {}
-
-    def _register(self, name, datagroup):
+        self._file_gen = {}
+        self._file_atime = {}
+        self._file_swmr = {}
+        self._pinned_files = set()
+        self._max_open_files = MAX_OPEN_FILES
+        self._file_idle_timeout = FILE_IDLE_TIMEOUT
+        self._files_lock = threading.RLock()
+        self._nopens = 0
+        self._ncloses = 0
+        self._nreopens = 0
+        self._datagroups = ProxyRegistry()
+        self._last_evict = time.time()
+        self._proxy_evict = PROXY_EVICT
+        self._proxy_timeout = PROXY_IDLE_TIMEOUT
+        self._proxy_max = PROXY_MAX
+        self._workers = []
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._cache = SliceCache(CACHE_SIZE)
+        self._backup = BackupService(self)
+        self._flushers = {}
+        self._coalescers = set()
+        self._overallocated = {}
+        self._shm_segments = {}
+        self._version = 0
+        self._batch_depth = 0
+        self._batch_flushers = []
+        self._batch_coalescers = {}
+        self._stats = CallStats()
+        self._io = IOExecutor(IO_THREADS)
+        self._subscriptions = set()
+        self._emits = Queue.Queue()
+        self._loop_thread = threading.current_thread()
+        self._version_lock = threading.Lock()
+        self._stats_file = STATS_FILE
+        self._stats_interval = STATS_INTERVAL
+        self._last_stats_dump = time.time()
+
+    def _register(self, datagroup):
         '''
-        Register a new DataGroup object.
+        Register a new DataGroup or DataSet object.
         '''
         objsh.register(datagroup)
-        self._datagroups[name] = datagroup
+        self._datagroups.add(datagroup._h5f.file.filename, datagroup._h5f.name, datagroup)
 
     def _unregister(self, name):
         objsh.helper.unregister(self._datagroups.pop(name))
 
+    def _unregister_tree(self, name):
+        '''
+        Unregister the object <name> and all objects below it.
+        '''
+        for proxy in self._datagroups.pop_tree(name):
+            self._set_coalescer(proxy, 0, None)
+            for sub in list(proxy._subscriptions):
+                sub.release()
+            objsh.helper.unregister(proxy)
+
+    def _is_pinned(self, proxy):
+        '''
+        Return whether <proxy> should not be evicted: file roots, objects
+        with subscriptions or signal coalescing, and objects in files with
+        submitted calls pending.
+        '''
+        return proxy._coalescer is not None or bool(proxy._subscriptions) or proxy._path == '/' \
+            or proxy._fn in self._io._queues
+
+    def _evict(self, timeout=None, max_proxies=None):
+        '''
+        Release proxies idle for more than <timeout> seconds, and the least
+        recently used ones if more than <max_proxies> are registered. Only
+        proxies without registered children are evicted; a client can get a
+        new proxy through the parent group.
+        '''
+        if timeout is None:
+            timeout = self._proxy_timeout
+        if max_proxies is None:
+            max_proxies = self._proxy_max
+        now = time.time()
+        candidates = [p for name, p in self._datagroups.items()
+            if self._datagroups.is_leaf(name) and not self._is_pinned(p)]
+        candidates.sort(key=lambda p: p._atime)
+        nexcess = len(self._datagroups) - max_proxies
+        evicted = 0
+        for i, p in enumerate(candidates):
+            if i >= nexcess and now - p._atime < timeout:
+                break
+            p.release()
+            evicted += 1
+        if evicted:
+            logging.debug('Evicted %d proxies, %d left', evicted, len(self._datagroups))
+        return evicted
+
+    def set_proxy_eviction(self, enabled=True, idle_timeout=None, max_proxies=None):
+        '''
+        Enable or disable evicting DataGroup and DataSet proxies unused for
+        <idle_timeout> seconds and the least recently used ones beyond
+        <max_proxies>, and evict right away if enabled. Returns the number
+        of proxies evicted.
+
+        objectsharer does not report which proxies clients still hold or
+        are connected to, so an evicted proxy silently stops working for a
+        client that kept it: only enable eviction if clients get objects
+        by indexing again rather than keeping them, and use subscribe()
+        (which pins the object) instead of connecting to signals.
+        '''
+        evicted = sum(w.set_proxy_eviction(enabled, idle_timeout=idle_timeout, max_proxies=max_proxies)
+                      for w in self._workers)
+        self._proxy_evict = enabled
+        if idle_timeout is not None:
+            self._proxy_timeout = idle_timeout
+        if max_proxies is not None:
+            self._proxy_max = max_proxies
+        if enabled:
+            evicted += self._evict()
+        return evicted
+
     def __getitem__(self, name):
         return self.get_file(name)
 
-    def get_file(self, fn, open=True):
+    def _add_worker(self, worker):
+        '''
+        Add data server proxy <worker>. Once workers are added this server
+        acts as a router: every file is owned by one of the workers, picked
+        by a hash of its name, and file requests are forwarded to it.
+        The worker's 'file-added' signals are emitted by this server, also
+        for files closed through DataGroup.close() and opened again.
+        '''
+        self._workers.append(worker)
+        worker.connect('file-added', lambda fn: _emit(self, 'file-added', fn))
+
+    def _get_worker(self, fn):
+        if isinstance(fn, unicode):
+            fn = fn.encode('utf-8')
+        return self._workers[(zlib.crc32(fn) & 0xffffffff) % len(self._workers)]
+
+    def get_file(self, fn, open=True, swmr=SWMR):
         '''
         Return a data object for file <fn>.
         If <open> == True (default), open the file in not yet opened.
+        If <swmr> == True, the file is opened with the latest file format,
+        so that it can be switched to single-writer/multiple-reader mode
+        with start_swmr().
         '''
         fn = os.path.abspath(fn)
-        check_backup(fn)
-        f = self._hdf5_files.get(fn, None)
+        if self._workers:
+            return self._get_worker(fn).get_file(fn, open=open, swmr=swmr)
 
-        if f is None:
+        self._backup.request(fn)
+        if fn not in self._flushers:
             if not open:
                 return None
-            f = h5py.File(fn, 'a')
-            self._hdf5_files[fn] = f
+            self._file_swmr[fn] = bool(swmr)
+            f = self._get_h5file(fn)
+            self._flushers[fn] = FlushScheduler(f, self._get_lock(fn))
             dg = DataGroup(f)
-            self.emit('file-added', fn)
-        groupname = f.filename + '/'
-        return self._datagroups[groupname]
+            _emit(self, 'file-added', fn)
+        elif swmr and not self._file_swmr[fn]:
+            raise ValueError('File %s is already open without SWMR support, close it first' % (fn, ))
+        return self._datagroups[fn + '/']
+
+    def _get_h5file(self, fn):
+        '''
+        Return the open h5py File for <fn>, (re)opening it if necessary and
+        closing the least recently used files beyond MAX_OPEN_FILES.
+        '''
+        with self._files_lock:
+            self._file_atime[fn] = time.time()
+            f = self._hdf5_files.get(fn, None)
+            if f is not None:
+                return f
+            if self._file_swmr.get(fn, False):
+                f = h5py.File(fn, 'a', libver='latest')
+            else:
+                f = h5py.File(fn, 'a')
+            if fn in self._flushers:
+                self._nreopens += 1
+                logging.debug('reopened file ' + fn)
+            self._nopens += 1
+            self._hdf5_files[fn] = f
+            self._file_gen[fn] = self._file_gen.get(fn, 0) + 1
+            if fn in self._flushers:
+                self._flushers[fn]._h5f = f
+            self._close_idle(max_files=self._max_open_files, exclude=fn)
+            return f
+
+    def _file_pinned(self, fn):
+        '''
+        Return whether file <fn> should be kept open: if pinned with
+        pin_file(), in SWMR mode, having submitted calls queued or objects
+        with subscriptions or signal coalescing.
+        '''
+        if fn in self._pinned_files or fn in self._io._queues:
+            return True
+        if getattr(self._hdf5_files.get(fn, None), 'swmr_mode', False):
+            return True
+        # I/O threads get here through _close_idle(), so iterate over copies
+        # of the sets the main loop changes
+        for sub in list(self._subscriptions):
+            if sub._obj._fn == fn:
+                return True
+        for coalescer in list(self._coalescers):
+            if coalescer._changed_obj._fn == fn:
+                return True
+        return False
+
+    def _close_file(self, fn):
+        '''
+        Close file <fn>, keeping its proxies; they reopen it when used.
+        '''
+        with self._files_lock:
+            with self._get_lock(fn):
+                f = self._hdf5_files.get(fn, None)
+                if f is None:
+                    return
+                if f.id:
+                    self._trim_file(fn)
+                    flusher = self._flushers.get(fn, None)
+                    if flusher is not None:
+                        flusher.flush_now()
+                    else:
+                        f.flush()
+                    f.close()
+                del self._hdf5_files[fn]
+                self._file_gen[fn] += 1
+                self._ncloses += 1
+        logging.debug('closed idle file ' + fn)
+
+    def _close_idle(self, timeout=None, max_files=None, exclude=None):
+        '''
+        Close files unused for <timeout> seconds and the least recently
+        used ones if more than <max_files> are open, except pinned ones.
+        Files of which the lock is held, e.g. by the backup service, are
+        skipped rather than waited for.
+        '''
+        with self._files_lock:
+            now = time.time()
+            candidates = [fn for fn in self._hdf5_files if fn != exclude and not self._file_pinned(fn)]
+            candidates.sort(key=lambda fn: self._file_atime.get(fn, 0))
+            nexcess = len(self._hdf5_files) - max_files if max_files is not None else 0
+            for i, fn in enumerate(candidates):
+                if i >= nexcess and (timeout is None or now - self._file_atime.get(fn, 0) < timeout):
+                    break
+                lock = self._get_lock(fn)
+                if not lock.acquire(False):
+                    continue
+                try:
+                    self._close_file(fn)
+                finally:
+                    lock.release()
+
+    def repack(self, fn):
+        '''
+        Rewrite file <fn> without the space left by deleted objects, which
+        HDF5 does not reclaim. The file is closed, copied and reopened when
+        next used. Returns a dict with the file size before and after.
+
+        Objects are copied one at a time, so a file holding an object under
+        several names (e.g. after assigning a DataSet to a group key) is
+        refused, as these would become separate copies. Object references
+        stored in attributes, other than dimension scales, are not updated.
+        '''
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).repack(fn)
+        if fn not in self._flushers:
+            raise ValueError('File %s is not open' % (fn, ))
+        if getattr(self._hdf5_files.get(fn, None), 'swmr_mode', False):
+            raise ValueError('Unable to repack file %s in SWMR mode' % (fn, ))
+        if fn in self._io._queues:
+            raise ValueError('Unable to repack file %s with submitted calls pending' % (fn, ))
+        tmpname = fn + '.repack'
+        kwargs = dict(libver='latest') if self._file_swmr[fn] else {}
+        with self._files_lock:
+            with self._get_lock(fn):
+                self._close_file(fn)
+                before = os.path.getsize(fn)
+                with h5py.File(fn, 'r') as src:
+                    linked = _hard_linked(src)
+                    if linked:
+                        raise ValueError('Unable to repack file %s, objects with several links: %s' % (fn, ', '.join(linked)))
+                    with h5py.File(tmpname, 'w', **kwargs) as dst:
+                        _copy_file(src, dst)
+                if os.name == 'nt':
+                    os.remove(fn)
+                os.rename(tmpname, fn)
+        self._cache.invalidate_tree(fn)
+        logging.info('Repacked %s from %d to %d bytes', fn, before, os.path.getsize(fn))
+        return dict(before=before, after=os.path.getsize(fn))
+
+    def set_file_pool(self, max_files=None, idle_timeout=None):
+        '''
+        Set the maximum number of open files and the time in seconds after
+        which unused files are closed.
+        '''
+        for w in self._workers:
+            w.set_file_pool(max_files=max_files, idle_timeout=idle_timeout)
+        if max_files is not None:
+            self._max_open_files = max_files
+            self._close_idle(max_files=max_files)
+        if idle_timeout is not None:
+            self._file_idle_timeout = idle_timeout
+
+    def pin_file(self, fn, pinned=True):
+        '''
+        Keep file <fn> open (if <pinned> == True), e.g. while a measurement
+        writes to it, or allow the file pool to close it again. Pinning
+        opens the file as get_file() does.
+        '''
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).pin_file(fn, pinned=pinned)
+        if pinned:
+            self.get_file(fn)
+            self._pinned_files.add(fn)
+        else:
+            self._pinned_files.discard(fn)
+
+    def start_swmr(self, fn):
+        '''
+        Switch file <fn>, opened with get_file(fn, swmr=True), to SWMR mode.
+        Local readers can then open it directly, see
+        dataserver_helpers.get_local_handle(), and treat the 'changed' and
+        'resize' signals as hints to refresh.
+
+        In SWMR mode no groups, data sets or attributes can be created, so
+        create the file structure first. Data sets are trimmed and no longer
+        over-allocated when extended.
+        '''
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).start_swmr(fn)
+        if fn not in self._flushers:
+            raise ValueError('File %s is not open' % (fn, ))
+        f = self._get_h5file(fn)
+        with self._get_lock(fn):
+            self._trim_file(fn)
+            self._flushers[fn].flush_now()
+            f.swmr_mode = True
+
+    def get_swmr_info(self, fn):
+        '''
+        Return a dict with the absolute filename, whether file <fn> is in
+        SWMR mode and the server's host name.
+        '''
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).get_swmr_info(fn)
+        f = self._hdf5_files.get(fn, None)
+        swmr = f is not None and bool(getattr(f, 'swmr_mode', False))
+        return dict(filename=fn, swmr=swmr, hostname=socket.gethostname())
 
     def list_files(self, names_only=True):
-        files = self._hdf5_files.keys()
+        if self._workers:
+            if names_only:
+                return sum((w.list_files() for w in self._workers), [])
+            files = {}
+            for w in self._workers:
+                files.update(w.list_files(names_only=False))
+            return files
+
+        files = self._flushers.keys()
         if names_only:
             return files
         else:
@@ -385,31 +3146,392 @@ class DataServer(object):
 
     def remove_file(self, fn):
         fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).remove_file(fn)
+
         logging.debug('removing file ' + fn)
-        self._hdf5_files.pop(fn).close()
-        for name in self._datagroups.keys():
-            if name.split('/')[0] == fn:
-                del self._datagroups[name]
+        with self._files_lock:
+            self._close_file(fn)
+            self._flushers.pop(fn)
+            self._file_swmr.pop(fn, None)
+            self._file_atime.pop(fn, None)
+            self._pinned_files.discard(fn)
+        self._cache.invalidate_tree(fn)
+        self._unregister_tree(fn + '/')
 
     def get_data(self, fn, group, create=False):
         '''
         Return a data object for <group> in <file>.
         '''
+        if self._workers:
+            return self._get_worker(os.path.abspath(fn)).get_data(fn, group, create=create)
         fullname = fn + group
         dg = self._datagroups.get(fullname, None)
         return dg
 
+    def _next_version(self):
+        '''
+        Return a new version number, unique within this server.
+        '''
+        with self._version_lock:
+            self._version += 1
+            return self._version
+
+    def _add_overallocated(self, h5f):
+        '''
+        Remember over-allocated HDF5 data set <h5f> so it is trimmed on close.
+        '''
+        self._overallocated.setdefault(h5f.file.filename, set()).add(h5f.name)
+
+    def _remove_overallocated(self, fn, name):
+        self._overallocated.get(fn, set()).discard(name)
+
+    def _trim_file(self, fn):
+        '''
+        Trim all over-allocated data sets in file <fn> to their length.
+        '''
+        f = self._hdf5_files[fn]
+        for name in self._overallocated.pop(fn, ()):
+            if name not in f:
+                continue
+            ds = self._datagroups.get(fn + name, None)
+            if isinstance(ds, DataSet):
+                ds._trim()
+            else:
+                _trim_dataset(f[name])
+
+    def _get_lock(self, fn):
+        '''
+        Return the lock that is held while file <fn> is being modified.
+        '''
+        with self._locks_lock:
+            lock = self._locks.get(fn, None)
+            if lock is None:
+                lock = self._locks[fn] = threading.RLock()
+            return lock
+
+    def _snapshot(self, fn):
+        '''
+        Flush file <fn> if it is open and return its write count, which
+        changes if the file is modified.
+        '''
+        with self._get_lock(fn):
+            flusher = self._flushers.get(fn, None)
+            if flusher is None:
+                return None
+            flusher.flush_now()
+            return flusher.nwrites
+
+    def get_backup_status(self, fn=None):
+        '''
+        Return the status of today's backup of file <fn>, or a dict with the
+        status of all files if fn is None. The status is a dict with keys
+        state ('queued', 'copying', 'done', 'skipped' or 'failed'),
+        backup_file, size, copied and error.
+        '''
+        if self._workers:
+            if fn is not None:
+                fn = os.path.abspath(fn)
+                return self._get_worker(fn).get_backup_status(fn)
+            status = {}
+            for w in self._workers:
+                status.update(w.get_backup_status())
+            return status
+        if fn is not None:
+            fn = os.path.abspath(fn)
+        return self._backup.get_status(fn)
+
+    def get_cache_stats(self):
+        '''
+        Return hit, miss, eviction and invalidation counts and the size of
+        the slice cache.
+        '''
+        if self._workers:
+            stats = {}
+            for w in self._workers:
+                for k, v in w.get_cache_stats().iteritems():
+                    stats[k] = stats.get(k, 0) + v
+            return stats
+        return self._cache.get_stats()
+
+    def set_cache_size(self, nbytes):
+        '''
+        Set the maximum size of the slice cache in bytes, 0 to disable it.
+        '''
+        for w in self._workers:
+            w.set_cache_size(nbytes)
+        self._cache.set_size(nbytes)
+
+    def _in_batch(self):
+        return self._batch_depth and threading.current_thread() is self._loop_thread
+
+    def _get_flusher(self, fn):
+        flusher = self._flushers[fn]
+        if self._in_batch() and not flusher.held:
+            flusher.hold()
+            self._batch_flushers.append(flusher)
+        return flusher
+
+    def set_flush_mode(self, fn, mode, interval=None, size=None):
+        '''
+        Set the flush mode for file <fn>, see FlushScheduler for the
+        available modes. <interval> is in ms, <size> in bytes.
+        '''
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).set_flush_mode(fn, mode, interval=interval, size=size)
+        self._get_flusher(fn).set_mode(mode, interval=interval, size=size)
+
+    def get_flush_mode(self, fn):
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).get_flush_mode(fn)
+        return self._get_flusher(fn).get_mode()
+
+    def flush_now(self, fn=None):
+        '''
+        Flush pending writes to file <fn>, or to all files if fn is None.
+        '''
+        if self._workers:
+            if fn is None:
+                for w in self._workers:
+                    w.flush_now()
+            else:
+                fn = os.path.abspath(fn)
+                self._get_worker(fn).flush_now(fn)
+            return
+        if fn is None:
+            flushers = self._flushers.values()
+        else:
+            flushers = [self._get_flusher(os.path.abspath(fn))]
+        for flusher in flushers:
+            flusher.flush_now()
+
+    def _poll(self):
+        '''
+        Periodic house keeping, called from the backend main loop.
+        '''
+        while not self._emits.empty():
+            obj, signal, args = self._emits.get()
+            _deliver(obj, signal, args)
+        for sub in list(self._subscriptions):
+            sub._poll()
+        for flusher in self._flushers.values():
+            flusher.poll()
+        for coalescer in list(self._coalescers):
+            coalescer.poll()
+        self._shm_cleanup()
+        if time.time() - self._last_evict > EVICT_INTERVAL:
+            # Reset first, so a failure does not repeat on every poll
+            self._last_evict = time.time()
+            if self._proxy_evict:
+                self._evict()
+            self._close_idle(timeout=self._file_idle_timeout)
+        if self._stats_file and time.time() - self._last_stats_dump > self._stats_interval:
+            self._dump_stats()
+        return True
+
+    def get_stats(self, reset=False):
+        '''
+        Return call statistics (see CallStats) and the number of open files
+        and shared objects. If <reset> == True, clear the statistics.
+        When routing to workers, their statistics are listed under 'workers'.
+        '''
+        stats = self._local_stats()
+        stats['io'] = self._io.get_stats()
+        if self._workers:
+            stats['workers'] = [w.get_stats(reset=reset) for w in self._workers]
+        if reset:
+            self._stats.reset()
+        return stats
+
+    def set_stats_dump(self, fn, interval=None):
+        '''
+        Periodically write statistics to file <fn> as JSON, every <interval>
+        seconds (default STATS_INTERVAL). Pass fn=None to stop.
+        Workers write to <fn> with '-worker<i>' inserted before the extension.
+        '''
+        for i, w in enumerate(self._workers):
+            wfn = None
+            if fn is not None:
+                base, ext = os.path.splitext(fn)
+                wfn = '%s-worker%d%s' % (base, i, ext)
+            w.set_stats_dump(wfn, interval=interval)
+        self._stats_file = fn
+        if interval is not None:
+            self._stats_interval = interval
+
+    def _local_stats(self):
+        stats = self._stats.get_stats()
+        stats['files'] = len(self._flushers)
+        stats['open_files'] = len(self._hdf5_files)
+        stats['file_opens'] = self._nopens
+        stats['file_closes'] = self._ncloses
+        stats['file_reopens'] = self._nreopens
+        stats['objects'] = len(self._datagroups)
+        stats['subscriptions'] = [sub.get_stats() for sub in self._subscriptions]
+        return stats
+
+    def _dump_stats(self):
+        self._last_stats_dump = time.time()
+        stats = self._local_stats()
+        try:
+            with open(self._stats_file + '.tmp', 'w') as f:
+                json.dump(stats, f, indent=1, sort_keys=True)
+            if os.path.exists(self._stats_file):
+                os.remove(self._stats_file)
+            os.rename(self._stats_file + '.tmp', self._stats_file)
+        except (IOError, OSError), e:
+            logging.warning('Unable to write statistics to %s: %s', self._stats_file, e)
+
+    def _shm_export(self, data):
+        desc = shm_write(data, SHM_DIR)
+        self._shm_segments[desc['name']] = time.time()
+        return desc
+
+    def _shm_check(self, desc):
+        '''
+        Return segment descriptor <desc> received from a client with its
+        name resolved, raising ValueError unless it names a segment file in
+        SHM_DIR, so that clients can not make the server read or remove
+        other files.
+        '''
+        name = os.path.realpath(desc['name'])
+        base = os.path.basename(name)
+        if os.path.dirname(name) != os.path.realpath(SHM_DIR) or \
+                not base.startswith(SHM_PREFIX) or not base.endswith(SHM_SUFFIX):
+            raise ValueError('Invalid shared memory segment %r' % (desc['name'], ))
+        return dict(desc, name=name)
+
+    def _shm_cleanup(self, timeout=SHM_TIMEOUT):
+        '''
+        Remove shared memory segments that were not picked up by a client.
+        '''
+        now = time.time()
+        for name, t in self._shm_segments.items():
+            if now - t < timeout:
+                continue
+            del self._shm_segments[name]
+            if os.path.exists(name):
+                logging.warning('Removing stale shared memory segment %s', name)
+                os.remove(name)
+
+    def _get_coalescer(self, obj, changed_obj, resize_obj=None):
+        '''
+        Return the SignalCoalescer for <obj>: the one installed through
+        set_coalesce() or, while executing a batch, a temporary one. Returns
+        None if signals should be emitted directly.
+        '''
+        if obj._coalescer is not None:
+            return obj._coalescer
+        if not self._in_batch():
+            return None
+        coalescer = self._batch_coalescers.get(id(obj), None)
+        if coalescer is None:
+            coalescer = SignalCoalescer(0, changed_obj, resize_obj)
+            self._batch_coalescers[id(obj)] = coalescer
+        return coalescer
+
+    def _set_coalescer(self, obj, window, changed_obj, resize_obj=None):
+        '''
+        Install a SignalCoalescer with <window> ms on <obj>, or remove it
+        if window is 0.
+        '''
+        if obj._coalescer is not None:
+            obj._coalescer.flush()
+            self._coalescers.discard(obj._coalescer)
+            obj._coalescer = None
+        if window:
+            obj._coalescer = SignalCoalescer(window, changed_obj, resize_obj)
+            self._coalescers.add(obj._coalescer)
+
+    def submit(self, fn, method, *args, **kwargs):
+        '''
+        Call <method> of the data server with <args> and <kwargs> on an I/O
+        thread, serialized with other submitted calls for file <fn>, and
+        return a PendingResult immediately.
+
+        Calls on DataGroup and DataSet objects are submitted through their
+        own submit() method. The main loop keeps serving other clients, and
+        control calls like hello(), list_files() and get_stats(), while the
+        I/O runs. Only data methods can be submitted, see
+        SUBMIT_SERVER_METHODS, SUBMIT_GROUP_METHODS and
+        SUBMIT_DATASET_METHODS. See also dataserver_helpers.wait().
+        '''
+        fn = os.path.abspath(fn)
+        if self._workers:
+            return self._get_worker(fn).submit(fn, method, *args, **kwargs)
+        _check_submit(self, method)
+        return self._io.submit(fn, getattr(self, method), *args, **kwargs)
+
+    def batch(self, ops):
+        '''
+        Execute a list of operations in one call and return their results.
+
+        Each operation is a tuple (target, method, args, kwargs), where
+        target is None for the data server itself or the index of an earlier
+        operation whose result the method is called on. Flushing is postponed
+        until all operations have been executed and 'changed'/'resize'
+        signals are coalesced to one per touched object. If an operation
+        fails, the remaining ones are skipped and a BatchError is raised.
+
+        See dataserver_helpers.Batch for the client side.
+        '''
+        results = []
+        self._batch_depth += 1
+        try:
+            for i, (target, method, args, kwargs) in enumerate(ops):
+                if method.startswith('_') and method not in BATCH_SPECIAL_METHODS:
+                    raise ValueError('Method %s not allowed in batch' % (method, ))
+                if target is None:
+                    obj = self
+                else:
+                    obj = results[target]
+                try:
+                    results.append(getattr(obj, method)(*args, **(kwargs or {})))
+                except Exception, e:
+                    raise BatchError(i, method, e), None, sys.exc_info()[2]
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._end_batch()
+        return results
+
+    def _end_batch(self):
+        flushers, self._batch_flushers = self._batch_flushers, []
+        coalescers, self._batch_coalescers = self._batch_coalescers, {}
+        for flusher in flushers:
+            flusher.resume()
+        for coalescer in coalescers.values():
+            coalescer.flush()
+
     def quit(self):
+        for w in self._workers:
+            w.quit(async=True)
+        self._io.shutdown(WORKER_TIMEOUT)
         logging.info('Closing files...')
-        for file in self._hdf5_files.values():
-            if file.id:
-                file.close()
+        for fn, file in self._hdf5_files.items():
+            with self._get_lock(fn):
+                if file.id:
+                    self._trim_file(fn)
+                    self._flushers[fn].flush_now()
+                    file.close()
+        self._shm_cleanup(timeout=0)
+        for p in _worker_processes:
+            p.join(WORKER_TIMEOUT)
         import sys
         sys.exit()
 
     def hello(self):
         return "hello"
 
+    def get_host_info(self):
+        '''
+        Return host name and shared memory directory, allowing clients to
+        decide whether they can use the shared memory transfer path.
+        '''
+        return dict(hostname=socket.gethostname(), shm_dir=SHM_DIR)
+
 def print_stats():
     print 'Sharing %d data objects (objectsharer reports %d)' % (len(dataserv._datagroups), len(objsh.helper.objects))
     return True
@@ -417,28 +3539,98 @@ def print_stats():
 logging.info('Starting data server...')
 dataserv = DataServer()
 objsh.register(dataserv, name='dataserver')
+_worker_processes = []
 
-def start(qt=False):
+def _start_backend(port):
     if hasattr(objsh, 'ZMQBackend'):
         backend = objsh.ZMQBackend()
     else:
         backend = objsh.backend
-    backend.start_server(addr='127.0.0.1', port=55556)
+    backend.start_server(addr='127.0.0.1', port=port)
+    backend.timeout_add(POLL_INTERVAL, dataserv._poll)
+    return backend
+
+def _main_loop(backend):
+    import signal
+    for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: dataserv.quit())
+    backend.timeout_add(10000, print_stats)
+    backend.main_loop()
+
+def _set_backup_dir(backup_dir):
+    global BACKUP_DIR
+    if backup_dir is not None:
+        BACKUP_DIR = backup_dir
+
+def _run_worker(i, port, backup_dir=None):
+    '''
+    Entry point for worker process <i>, which serves its files on <port>.
+    '''
+    global dataserv
+    _set_backup_dir(backup_dir)
+    del _worker_processes[:]
+    objsh.helper.unregister(dataserv)
+    dataserv = DataServer()
+    if STATS_FILE:
+        base, ext = os.path.splitext(STATS_FILE)
+        dataserv._stats_file = '%s-worker%d%s' % (base, i, ext)
+    objsh.register(dataserv, name=WORKER_NAME % i)
+    _main_loop(_start_backend(port))
+
+def _connect_workers(backend, port, nworkers):
+    for i in range(nworkers):
+        backend.connect_to('tcp://127.0.0.1:%d' % (port + 1 + i, ))
+    for i in range(nworkers):
+        start = time.time()
+        worker = None
+        while worker is None:
+            try:
+                worker = objsh.helper.find_object(WORKER_NAME % i)
+            except Exception, e:
+                if time.time() - start > WORKER_TIMEOUT:
+                    raise Exception('Unable to connect to worker %d: %s' % (i, e))
+                time.sleep(0.1)
+        dataserv._add_worker(worker)
+
+def start(qt=False, port=PORT, nworkers=WORKERS, backup_dir=None):
+    '''
+    Start the data server on <port>, writing backups to <backup_dir>
+    instead of BACKUP_DIR if given ('' disables backups).
+
+    If <nworkers> > 0, HDF5 files are handled by that many worker
+    processes, listening on the ports following <port>, and this process
+    only routes requests to them. Files are assigned to workers by a hash
+    of their name; the DataGroup and DataSet objects returned are owned by
+    the workers, so clients talk to those directly after the first call.
+    '''
+    _set_backup_dir(backup_dir)
+    for i in range(nworkers):
+        p = multiprocessing.Process(target=_run_worker, args=(i, port + 1 + i, backup_dir))
+        p.daemon = True
+        p.start()
+        _worker_processes.append(p)
+
+    backend = _start_backend(port)
+    _connect_workers(backend, port, nworkers)
     if qt:
         backend.add_qt_timer(10)
     else:
-        import signal
-        for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM):
-            signal.signal(sig, lambda *args: dataserv.quit())
-        backend.timeout_add(10000, print_stats)
-        backend.main_loop()
+        _main_loop(backend)
 
 if __name__ == "__main__":
     import os
+    import argparse
     from dataserver_helpers import DATA_DIRECTORY
+    parser = argparse.ArgumentParser(description='Shared HDF5 data server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+        help='number of worker processes handling the HDF5 files')
+    parser.add_argument('--backup-dir',
+        help='directory for daily backups instead of the configured one, empty to disable backups')
+    args = parser.parse_args()
     try:
         os.chdir(DATA_DIRECTORY)
     except:
         pass
-    start()
+    start(port=args.port, nworkers=args.workers, backup_dir=args.backup_dir)
 
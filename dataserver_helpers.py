@@ -1,8 +1,23 @@
+import os
 import time
+import socket
+import tempfile
+import numpy as np
 import objectsharer
 
 DATA_DIRECTORY = r'C:\_Data'
 
+# Arrays larger than this are transferred through shared memory when the
+# client runs on the same host as the data server.
+SHM_MIN_BYTES = 1024 * 1024
+if os.path.isdir('/dev/shm'):
+    SHM_DIR = '/dev/shm'
+else:
+    SHM_DIR = tempfile.gettempdir()
+# Shared memory segments are files named SHM_PREFIX + <random> + SHM_SUFFIX
+SHM_PREFIX = 'dataserver_'
+SHM_SUFFIX = '.shm'
+
 def dataserver_client(serveraddr='127.0.0.1', serverport=55556, localaddr='127.0.0.1'):
     import objectsharer as objsh
     if objsh.helper.backend is None:
@@ -27,14 +42,128 @@ def get_file(filename, groupname="", timestamp_group=False, **kwargs):
         f = f.create_group(time.strftime('%H:%M:%S' + groupname))
     return f
 
-def run_dataserver(qt=False):
+class BatchResult(object):
+    '''
+    Placeholder for the result of an operation queued in a Batch.
+
+    Calling methods on it, indexing it or assigning items queues further
+    operations on the (future) result. The actual result is available as
+    <result> once the batch has been executed.
+    '''
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    @property
+    def result(self):
+        if self._batch.results is None:
+            raise ValueError('Batch not executed yet')
+        return self._batch.results[self._index]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def queue(*args, **kwargs):
+            return self._batch._queue(self._index, name, args, kwargs)
+        return queue
+
+    def __getitem__(self, key):
+        return self._batch._queue(self._index, '__getitem__', (key, ), {})
+
+    def __setitem__(self, key, val):
+        self._batch._queue(self._index, '__setitem__', (key, val), {})
+
+    def __delitem__(self, key):
+        self._batch._queue(self._index, '__delitem__', (key, ), {})
+
+class Batch(object):
+    '''
+    Queue operations on the data server and send them in one message, to be
+    executed in order by DataServer.batch() with a single flush and
+    coalesced signals. Use as a context manager:
+
+        with Batch() as b:
+            g = b.get_file('test.h5').create_group('run')
+            g.set_attrs(operator='me')
+            d = g.create_dataset('xs', rank=1)
+            d.extend([1, 2, 3])
+        g = g.result
+    '''
+
+    def __init__(self, client=None):
+        self._client = client
+        self._ops = []
+        self.results = None
+        self.server = BatchResult(self, None)
+
+    def _queue(self, target, method, args, kwargs):
+        self._ops.append((target, method, args, kwargs))
+        return BatchResult(self, len(self._ops) - 1)
+
+    def get_file(self, fn):
+        return self.server.get_file(fn)
+
+    def execute(self):
+        '''
+        Send the queued operations and return the list of results.
+        '''
+        client = self._client
+        if client is None:
+            client = dataserver_client()
+        self.results = client.batch(self._ops)
+        self._ops = []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+def batch(client=None):
+    return Batch(client)
+
+def wait(pending, timeout=None, interval=0.01):
+    '''
+    Wait until the call behind <pending>, a PendingResult returned by a
+    submit() call on the data server, DataGroup or DataSet, has finished
+    and return its result. Raises the call's exception if it failed.
+    '''
+    start = time.time()
+    while not pending.is_done():
+        if timeout is not None and time.time() - start > timeout:
+            raise Exception('Timeout waiting for submitted call')
+        time.sleep(interval)
+    return pending.get_result()
+
+def subscribe(obj, callback, **kwargs):
+    '''
+    Subscribe to the signals of DataGroup or DataSet <obj> and call
+    callback(signal, *args) for every event. Keyword arguments are passed
+    to obj.subscribe() to filter events and bound the server side queue.
+
+    Events are fetched when the server signals that they are pending, so
+    a slow callback makes the server drop or collapse events instead of
+    queueing them. Returns the subscription, call release() to cancel it.
+    '''
+    sub = obj.subscribe(**kwargs)
+    def pending(n=None):
+        for signal, args in sub.fetch():
+            callback(signal, *args)
+    sub.connect('pending', pending)
+    pending()
+    return sub
+
+def run_dataserver(qt=False, **kwargs):
     from dataserver import start
     import os
     try:
         os.chdir(DATA_DIRECTORY)
     except:
         pass
-    start(qt)
+    start(qt, **kwargs)
 
 
 def resolve_file(filename, path):
@@ -44,6 +173,8 @@ def resolve_file(filename, path):
     return file.get_numbered_child()
 
 def get_group(file, groupname):
+    if isinstance(file, objectsharer.ObjectProxy):
+        return file.get_group(groupname)    # Single round trip
     if groupname not in file:
         file.create_group(groupname)
     return file[groupname]
@@ -58,6 +189,8 @@ def resolve_path(file, path):
     return cur
 
 def get_numbered_child(file):
+    if isinstance(file, objectsharer.ObjectProxy):
+        return file.get_numbered_child()    # Indexed and atomic on the server
     max_n = 0
     for k in file.keys():
         try:
@@ -83,3 +216,131 @@ def update_attrs(group, dict):
         for k in dict:
             print k, dict[k]
             group.attrs[k] = dict[k]
+
+def shm_write(data, dirname=SHM_DIR):
+    '''
+    Copy array <data> into a new shared memory segment (a memory mapped file
+    in <dirname>) and return its descriptor.
+    '''
+    data = np.ascontiguousarray(data)
+    fd, name = tempfile.mkstemp(prefix=SHM_PREFIX, suffix=SHM_SUFFIX, dir=dirname)
+    os.close(fd)
+    if data.nbytes > 0:
+        mm = np.memmap(name, dtype=data.dtype, mode='w+', shape=data.shape)
+        mm[...] = data
+        mm.flush()
+        del mm
+    if data.dtype.fields is not None:
+        dtype = data.dtype.descr
+    else:
+        dtype = data.dtype.str
+    return dict(name=name, shape=data.shape, dtype=dtype, offset=0)
+
+def shm_read(desc, remove=True):
+    '''
+    Return a copy of the array in the shared memory segment described by
+    <desc>, removing the segment if <remove> is True.
+    '''
+    dtype = desc['dtype']
+    if isinstance(dtype, list):
+        dtype = [tuple(field) for field in dtype]
+    dtype = np.dtype(dtype)
+    shape = tuple(desc['shape'])
+    try:
+        if dtype.itemsize * int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype)
+        mm = np.memmap(desc['name'], dtype=dtype, mode='r', offset=desc['offset'], shape=shape)
+        data = np.array(mm)
+        del mm
+        return data
+    finally:
+        if remove:
+            os.remove(desc['name'])
+
+_shm_dir = {}
+
+def shm_dir(client=None):
+    '''
+    Return the server's shared memory directory if the data server runs on
+    this host and the directory is accessible, None otherwise.
+    '''
+    if client is None:
+        client = dataserver_client()
+    key = id(client)
+    if key not in _shm_dir:
+        info = client.get_host_info()
+        if info['hostname'] == socket.gethostname() and os.path.isdir(info['shm_dir']):
+            _shm_dir[key] = info['shm_dir']
+        else:
+            _shm_dir[key] = None
+    return _shm_dir[key]
+
+def fast_get(ds, idx=slice(None), client=None, min_bytes=SHM_MIN_BYTES):
+    '''
+    Return ds[idx], transferring the data through shared memory if it is
+    at least <min_bytes> large and the server runs on this host.
+    '''
+    if shm_dir(client) is None:
+        return ds[idx]
+    ret = ds.get_shm(idx, min_bytes)
+    if isinstance(ret, dict):
+        return shm_read(ret)
+    return ret
+
+def fast_set(ds, idx, val, client=None, min_bytes=SHM_MIN_BYTES):
+    '''
+    Perform ds[idx] = val, transferring the data through shared memory if
+    it is at least <min_bytes> large and the server runs on this host.
+    '''
+    dirname = shm_dir(client)
+    val = np.asarray(val)
+    if dirname is None or val.nbytes < min_bytes:
+        ds[idx] = val
+        return
+    desc = shm_write(val, dirname)
+    try:
+        ds.set_shm(idx, desc)
+    finally:
+        if os.path.exists(desc['name']):
+            os.remove(desc['name'])
+
+def get_local_handle(filename, path=None, client=None):
+    '''
+    Return a read-only h5py handle to <filename>, or to the object at
+    <path> in it, for reading directly instead of through the server.
+
+    The server must run on this host and have switched the file to SWMR
+    mode, see DataServer.start_swmr(). Call refresh() on data sets (e.g.
+    when the server emits 'changed' or 'resize') to see new data.
+    '''
+    import h5py
+    if client is None:
+        client = dataserver_client()
+    info = client.get_swmr_info(filename)
+    if info['hostname'] != socket.gethostname():
+        raise ValueError('Data server is not running on this host')
+    if not info['swmr']:
+        raise ValueError('File %s is not in SWMR mode' % (info['filename'], ))
+    f = h5py.File(info['filename'], 'r', libver='latest', swmr=True)
+    if path is None:
+        return f
+    return f[path]
+
+def iter_chunks(ds, axis=0, rows_per_chunk=None, _slice=None, client=None, min_bytes=SHM_MIN_BYTES):
+    '''
+    Iterate over ds[_slice] in blocks along <axis>, yielding tuples of the
+    block index (a tuple of slices) and the data. See
+    DataSet.get_chunk_ranges() for the block size.
+
+    Blocks are only requested when the previous one has been consumed, so
+    at most one block is held in memory by the server and by this client.
+    Blocks of at least <min_bytes> are transferred through shared memory if
+    the server runs on this host.
+    '''
+    if shm_dir(client) is None:
+        min_bytes = None
+    for block in ds.get_chunk_ranges(axis=axis, rows_per_chunk=rows_per_chunk, _slice=_slice):
+        data = ds.read_block(block, min_bytes)
+        if isinstance(data, dict):
+            data = shm_read(data)
+        yield tuple(block), data
@@ -0,0 +1,50 @@
+# shmtest.py, compare the objectsharer and shared memory transfer paths.
+# Requires a data server running on this host.
+
+import time
+import numpy as np
+import objectsharer as objsh
+import dataserver_helpers as dsh
+
+SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]     # float64 elements
+REPEAT = 5
+
+def timeit(func, *args):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        func(*args)
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+datasrv = dsh.dataserver_client()
+if dsh.shm_dir(datasrv) is None:
+    print 'Data server is not on this host, shared memory path not available'
+f = datasrv.get_file('shmtest.h5')
+
+print '%10s %12s %12s %12s %12s' % ('bytes', 'set rpc', 'set shm', 'get rpc', 'get shm')
+for n in SIZES:
+    name = 'data%d' % (n,)
+    if name in f:
+        del f[name]
+    ds = f.create_dataset(name, shape=(n,), dtype=np.float64)
+    ar = np.random.rand(n)
+
+    def set_rpc():
+        ds[:] = ar
+    def get_rpc():
+        return ds[:]
+
+    ts = (
+        timeit(set_rpc),
+        timeit(dsh.fast_set, ds, slice(None), ar, datasrv, 0),
+        timeit(get_rpc),
+        timeit(dsh.fast_get, ds, slice(None), datasrv, 0),
+    )
+    if np.count_nonzero(dsh.fast_get(ds) != ar) != 0:
+        raise Exception('Array does not match')
+    print '%10d %10.2fms %10.2fms %10.2fms %10.2fms' % ((ar.nbytes,) + tuple(t * 1000 for t in ts))
+
+f.close()
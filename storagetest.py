@@ -0,0 +1,56 @@
+# storagetest.py, compare storage policies and chunk shapes for 2D data sets.
+# Uses h5py directly, no data server needed.
+
+import os
+import time
+import tempfile
+import numpy as np
+import h5py
+from dataserver import storage_options, STORAGE_POLICIES, ACCESS_PATTERNS
+
+NROWS = 2000
+NCOLS = 1000
+NREADS = 50
+
+def make_data():
+    xs = np.linspace(0, 10, NCOLS)
+    rows = [np.sin(xs + 0.01 * i) + 0.01 * np.random.randn(NCOLS) for i in range(NROWS)]
+    return np.array(rows)
+
+def run(policy, access, data, dirname):
+    fn = os.path.join(dirname, 'storagetest_%s_%s.h5' % (policy, access))
+    opts = storage_options((0, NCOLS), data.dtype, policy, access, maxshape=(None, NCOLS))
+    with h5py.File(fn, 'w') as f:
+        ds = f.create_dataset('data', shape=(0, NCOLS), maxshape=(None, NCOLS), dtype=data.dtype, **opts)
+        start = time.time()
+        ds.resize((NROWS, NCOLS))
+        for i in range(NROWS):
+            ds[i] = data[i]
+        f.flush()
+        twrite = time.time() - start
+
+    with h5py.File(fn, 'r') as f:
+        ds = f['data']
+        idx = np.random.randint(NROWS, size=NREADS)
+        start = time.time()
+        for i in idx:
+            ds[i, :]
+        trow = (time.time() - start) / NREADS
+        idx = np.random.randint(NCOLS, size=NREADS)
+        start = time.time()
+        for i in idx:
+            ds[:, i]
+        tcol = (time.time() - start) / NREADS
+
+    size = os.path.getsize(fn)
+    os.remove(fn)
+    return opts['chunks'], data.nbytes / twrite / 1e6, trow * 1000, tcol * 1000, size / 1e6
+
+data = make_data()
+dirname = tempfile.mkdtemp()
+print '%-8s %-7s %-12s %10s %10s %10s %9s' % ('policy', 'access', 'chunks', 'write', 'row read', 'col read', 'size')
+for policy in sorted(STORAGE_POLICIES):
+    for access in ACCESS_PATTERNS:
+        chunks, mbps, trow, tcol, size = run(policy, access, data, dirname)
+        print '%-8s %-7s %-12s %6.1fMB/s %8.3fms %8.3fms %7.2fMB' % (policy, access, chunks, mbps, trow, tcol, size)
+os.rmdir(dirname)
@@ -7,21 +7,35 @@ import h5py
 import os
 import glob
 import time
+import sys
+import subprocess
+
+NUMBERED_CHILD_SCRIPT = '''
+import dataserver_helpers as ds
+run = ds.dataserver_client().get_file(%r)['run']
+for i in range(%d):
+    print run.get_numbered_child().get_fullname()
+'''
+
+class ServerTestCase(unittest.TestCase):
+    nworkers = 0
 
-class ClientServerTestCase(unittest.TestCase):
     def setUp(self):
-        self.server_process = multiprocessing.Process(target=ds.run_dataserver)
+        self.server_process = multiprocessing.Process(target=ds.run_dataserver,
+                                                      kwargs=dict(nworkers=self.nworkers))
         self.server_process.start()
         for f in glob.glob(os.path.join(ds.DATA_DIRECTORY, 'test_*.h5')):
             print 'Deleting', f
             os.remove(f)
-        time.sleep(.5)
+        time.sleep(.5 + self.nworkers)
         self.server_client = ds.dataserver_client()
 
     def tearDown(self):
-        self.server_client.quit(async=True)
+        if self.server_process.is_alive():
+            self.server_client.quit(async=True)
         self.server_process.join()
 
+class ClientServerTestCase(ServerTestCase):
     def testDataPersistence(self):
         c1 = ds.dataserver_client()
         filename = 'test_data_persistence.h5'
@@ -47,5 +61,434 @@ class ClientServerTestCase(unittest.TestCase):
             f1['data'].append(pt)
         assert all(data == f1['data'][:]), "data %s doesn't match filedata %s" % (data, f1['data'][:])
 
+    def testAppendTrimmed(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_append_trimmed.h5'
+        f1 = c1.get_file(filename)
+        f1.create_dataset('data', rank=1)
+        data = np.random.normal(size=(100,))
+        for pt in data:
+            f1['data'].append(pt)
+        assert f1['data'].get_shape() == (100,), 'logical shape %s != (100,)' % (f1['data'].get_shape(),)
+        f1.close()
+        f2 = h5py.File(os.path.join(ds.DATA_DIRECTORY, filename), 'r')
+        assert f2['data'].shape == (100,), 'data set not trimmed on close'
+        assert all(data == f2['data'][:]), 'data failed to match from h5py file'
+
+    def testReplaceOverallocated(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_replace_overallocated.h5'
+        f1 = c1.get_file(filename)
+        d = f1.create_dataset('data', rank=1, dtype=np.float64)
+        d.extend(np.arange(5.))
+        nalloc = f1.get_tree()['children'][0]['chunks'][0]
+        data = np.random.normal(size=nalloc)
+        f1['data'] = data
+        assert np.all(d[:] == data), 'replaced data does not match'
+        f1.close()
+        f2 = h5py.File(os.path.join(ds.DATA_DIRECTORY, filename), 'r')
+        assert np.all(f2['data'][:] == data), 'replaced data lost on close'
+        f2.close()
+
+    def testDecimated(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_decimated.h5')
+        data = np.arange(10000, dtype=np.float64)
+        d = f1.create_dataset('data', data=data, x0=0.0, xscale=0.5)
+        ret = d.get_decimated(max_points=100, method='mean')
+        assert len(ret['data']) == 100, 'decimated to %d points' % len(ret['data'])
+        assert all(ret['data'] == data.reshape(100, 100).mean(axis=1)), 'bin means do not match'
+        assert all(ret['x'] == 0.5 * ret['data']), 'coordinates do not match get_xpts()'
+        ret = d.get_decimated(max_points=100, method='minmax')
+        assert all(ret['min'] == data[::100]) and all(ret['max'] == data[99::100]), 'envelope does not match'
+
+    def testReadSince(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_read_since.h5')
+        d = f1.create_dataset('data', rank=1, dtype=np.float64)
+        d.extend([1, 2, 3])
+        version = d.get_version()
+        d.extend([4, 5])
+        ret = d.read_since(version)
+        assert not ret['full'] and [tuple(r) for r in ret['ranges']] == [(3, 5)], 'unexpected ranges %s' % (ret['ranges'],)
+        assert all(ret['data'][0] == [4, 5]), 'new data does not match'
+        assert d.read_since(ret['version'])['ranges'] == [], 'changes reported for current version'
+
+    def testBatch(self):
+        c1 = ds.dataserver_client()
+        with ds.batch(c1) as b:
+            g = b.get_file('test_batch.h5').create_group('run')
+            g.set_attrs(operator='test')
+            d = g.create_dataset('data', rank=1, dtype=np.float64)
+            d.extend([1, 2, 3])
+        f1 = c1.get_file('test_batch.h5')
+        assert f1['run'].get_attrs()['operator'] == 'test', 'attrs not set in batch'
+        assert all(f1['run']['data'][:] == [1, 2, 3]), 'data not written in batch'
+
+    def testBatchError(self):
+        c1 = ds.dataserver_client()
+        b = ds.batch(c1)
+        f = b.get_file('test_batch_error.h5')
+        f['missing'].get_shape()
+        try:
+            b.execute()
+        except Exception, e:
+            assert 'Batch operation 1 (__getitem__) failed' in str(e), 'unexpected error %s' % (e, )
+        else:
+            assert False, 'failing batch did not raise'
+
+    def testNumberedChild(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_numbered_child.h5'
+        f1 = c1.get_file(filename)
+        run = f1.create_group('run')
+        assert run.get_numbered_child().get_fullname().endswith('/run/1'), 'first child not numbered 1'
+        f1.create_group('run/5')
+        f1['run/7/data'] = np.arange(3)
+        assert run.get_numbered_child().get_fullname().endswith('/run/8'), 'index missed children added through the parent'
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        procs = [subprocess.Popen([sys.executable, '-c', NUMBERED_CHILD_SCRIPT % (filename, 20)],
+                                  stdout=subprocess.PIPE, env=env) for i in range(3)]
+        names = sum((p.communicate()[0].split() for p in procs), [])
+        assert len(names) == 60, 'expected 60 children, got %d' % len(names)
+        assert len(set(names)) == 60, 'numbered children handed out twice'
+
+    def testEviction(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_eviction.h5')
+        g = f1.create_group('group')
+        for i in range(20):
+            g['data%d' % i] = np.arange(10) * i
+            g['data%d' % i][:]
+        assert c1.get_stats()['objects'] == 22, 'unexpected number of proxies'
+        assert c1.set_proxy_eviction(True, max_proxies=5) == 17, 'least recently used proxies not evicted'
+        assert c1.get_stats()['objects'] == 5, 'proxies left after eviction'
+        assert np.all(g['data0'][:] == 0), 'data not available after eviction'
+        del f1['group']
+        assert c1.get_stats()['objects'] == 1, 'proxies below removed group not unregistered'
+
+    def testCacheInvalidation(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_cache.h5')
+        d = f1.create_dataset('data', data=np.zeros((10, 10)))
+        assert all(d[0,:] == 0) and all(d[0,:] == 0), 'unexpected data'
+        hits = c1.get_cache_stats()['hits']
+        assert hits >= 1, 'repeated read not served from cache'
+        d[0,:] = np.ones(10)
+        assert all(d[0,:] == 1), 'cached data not invalidated by write'
+
+    def testFlushMode(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_flush_mode.h5'
+        f1 = c1.get_file(filename)
+        c1.set_flush_mode(filename, 'close')
+        f1['data'] = np.arange(10)
+        assert c1.get_flush_mode(filename)['dirty'], 'write was flushed in on-close mode'
+        c1.flush_now(filename)
+        assert not c1.get_flush_mode(filename)['dirty'], 'flush_now() left pending writes'
+
+    def testBackupStatus(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_backup_status.h5'
+        f1 = c1.get_file(filename)
+        f1['data'] = np.arange(10)
+        f1.flush()
+        start = time.time()
+        status = c1.get_backup_status(filename)
+        while status['state'] != 'done' and time.time() - start < 10:
+            if status['state'] in ('skipped', 'failed'):
+                c1.get_file(filename)     # Request the backup again
+            time.sleep(0.1)
+            status = c1.get_backup_status(filename)
+        assert status['state'] == 'done', 'backup %s: %s' % (status['state'], status['error'])
+        assert os.path.exists(status['backup_file']), 'backup file missing'
+
+    def testShmPath(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_shm_path.h5')
+        f1['data'] = np.zeros(10)
+        fn = os.path.abspath('test_shm_path.txt')
+        with open(fn, 'w') as f:
+            f.write('keep')
+        desc = dict(name=fn, shape=(10, ), dtype=np.dtype(np.float64).str, offset=0)
+        self.assertRaises(Exception, f1['data'].set_shm, slice(None), desc)
+        assert os.path.exists(fn), 'server removed a file outside the shared memory directory'
+        os.remove(fn)
+
+    def testCoalesce(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_coalesce.h5')
+        g = f1.create_group('run')
+        d = g.create_dataset('data', rank=1, dtype=np.float64)
+        changed = g.subscribe(signals=['changed'])
+        resized = d.subscribe(signals=['resize'])
+        g.set_coalesce(200)
+        for i in range(10):
+            d.append(float(i))
+        time.sleep(0.5)
+        events = changed.fetch()
+        assert len(events) == 1, 'expected 1 changed signal, got %d' % len(events)
+        assert tuple(events[0][1]) == ('data', slice(0, 10)), 'changed slices not merged: %s' % (events[0][1], )
+        events = resized.fetch()
+        assert len(events) == 1, 'expected 1 resize signal, got %d' % len(events)
+        assert tuple(events[0][1][0]) == (10, ), 'resize does not carry the final shape'
+
+    def testStoragePolicy(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_storage_policy.h5')
+        g = f1.create_group('compact')
+        g.set_attrs(storage_policy='compact')
+        d = g.create_dataset('data', data=np.arange(1000))
+        node = [n for n in g.get_tree()['children'] if n['name'] == 'data'][0]
+        assert node['chunks'] is not None, 'compressed data set not chunked'
+        g.create_dataset('n', data=5)
+        assert tuple(g.create_dataset('r', shape=10, rank=1).get_shape()) == (10, ), 'integer shape not accepted'
+        g['m'] = np.array(3.5)
+        assert g['n'][()] == 5 and g['m'][()] == 3.5, 'scalars do not match'
+        assert np.all(d[:] == np.arange(1000)), 'compressed data does not match'
+
+    def testStats(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_stats.h5')
+        c1.get_stats(reset=True)
+        f1['data'] = np.arange(100, dtype=np.float64)
+        f1['data'][:]
+        calls = c1.get_stats()['calls']
+        assert calls['DataGroup.__setitem__']['count'] == 1, 'set call not counted'
+        assert calls['DataGroup.__setitem__']['bytes_in'] >= 800, 'bytes in not counted'
+        assert calls['DataSet.__getitem__']['bytes_out'] == 800, 'bytes out not counted'
+
+    def testIterChunks(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_iter_chunks.h5')
+        data = np.random.normal(size=(1000, 3))
+        f1['data'] = data
+        blocks = [block for idx, block in ds.iter_chunks(f1['data'], rows_per_chunk=100, client=c1)]
+        assert len(blocks) == 10, 'expected 10 blocks, got %d' % len(blocks)
+        assert np.all(np.concatenate(blocks) == data), 'blocks do not match data'
+
+    def testReduce(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_reduce.h5')
+        data = np.random.normal(size=(500, 4))
+        f1['data'] = data
+        d = f1['data']
+        assert np.allclose(d.reduce('mean', axis=0), data.mean(axis=0)), 'mean does not match'
+        assert np.allclose(d.reduce('std'), data.std()), 'std does not match'
+        assert np.allclose(d.reduce('max', axis=1), data.max(axis=1)), 'max does not match'
+        hist = d.histogram(bins=20, range=(-3, 3))
+        assert np.all(hist['counts'] == np.histogram(data, bins=20, range=(-3, 3))[0]), 'histogram does not match'
+
+    def testGetTree(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_get_tree.h5')
+        g = f1.create_group('group')
+        g['data'] = np.arange(10)
+        nobjects = c1.get_stats()['objects']
+        tree = f1.get_tree()
+        assert c1.get_stats()['objects'] == nobjects, 'get_tree() registered proxies'
+        group = [n for n in tree['children'] if n['name'] == 'group'][0]
+        assert group['type'] == 'group', 'wrong node type'
+        assert tuple(group['children'][0]['shape']) == (10, ), 'wrong data set shape'
+        assert 'children' not in f1.get_tree(depth=0), 'depth not respected'
+
+    def testSWMR(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_swmr.h5'
+        f1 = c1.get_file(filename, swmr=True)
+        d1 = f1.create_dataset('data', rank=1, dtype=np.float64)
+        c1.start_swmr(filename)
+        d1.extend(np.arange(10))
+        local = ds.get_local_handle(filename, '/data', client=c1)
+        d1.extend(np.arange(10))
+        local.refresh()
+        assert local.shape == (20, ), 'local reader sees shape %s' % (local.shape, )
+        assert np.all(local[10:] == np.arange(10)), 'local reader data does not match'
+
+    def testRingBuffer(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_ring.h5')
+        d1 = f1.create_dataset('data', dtype=np.float64, ring=10, x0=0, xscale=1)
+        d1.extend(np.arange(8))
+        assert np.all(d1[:] == np.arange(8)), 'ring buffer data does not match before wrapping'
+        d1.extend(np.arange(8, 15))
+        assert tuple(d1.get_shape()) == (10, ), 'ring buffer grew beyond its capacity'
+        assert np.all(d1[:] == np.arange(5, 15)), 'ring buffer not in chronological order'
+        assert np.all(d1[-3:] == np.arange(12, 15)), 'ring buffer slice does not match'
+        assert np.all(d1.get_xpts() == np.arange(5, 15)), 'ring buffer time axis does not match'
+        self.assertRaises(Exception, f1.__setitem__, 'data', np.arange(20.))
+        assert np.all(f1['data'][:] == np.arange(5, 15)), 'ring buffer changed by rejected assignment'
+
+    def testSubmit(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_submit.h5')
+        data = np.random.normal(size=100000)
+        ds.wait(f1.submit('__setitem__', 'data', data), timeout=10)
+        pending = f1['data'].submit('__getitem__', slice(None))
+        assert c1.hello() == 'hello', 'server not responsive during submitted call'
+        assert np.all(ds.wait(pending, timeout=10) == data), 'submitted read does not match'
+        self.assertRaises(Exception, f1.submit, 'create_group', 'group')
+        self.assertRaises(Exception, f1.submit, '__delitem__', 'data')
+        self.assertRaises(Exception, c1.submit, 'test_submit.h5', '__getitem__', 'test_submit.h5')
+        self.assertRaises(Exception, c1.submit, 'test_submit.h5', 'pin_file', 'test_submit.h5')
+
+    def testSubscription(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_subscription.h5')
+        sub = f1.subscribe(keys=['a'], signals=['changed'], maxlen=2)
+        for i in range(5):
+            f1['a'] = np.arange(10) * i
+        f1['b'] = np.arange(10)
+        events = sub.fetch()
+        assert len(events) == 2, 'expected 2 queued events, got %d' % len(events)
+        assert all(args[0] == 'a' for signal, args in events), 'key filter not applied'
+        assert sub.get_stats()['dropped'] == 3, 'dropped events not counted'
+        sub.release()
+
+    def testSubscriptionLatest(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_subscription_latest.h5')
+        d1 = f1.create_dataset('data', dtype=np.float64, rank=1)
+        sub = d1.subscribe(policy='latest')
+        for i in range(3):
+            d1.extend(np.arange(10.))
+            d1.set_attrs(count=i)
+        assert np.all(d1[:] == np.tile(np.arange(10.), 3)), 'extended data does not match'
+        assert d1.get_attrs()['count'] == 2, 'attributes not set'
+        events = dict(sub.fetch())
+        assert tuple(events['resize'][0]) == (30, ), 'latest resize not kept'
+        assert events['attrs-changed'][0]['count'] == 2, 'latest attributes not kept'
+        sub.release()
+
+    def testFilePool(self):
+        c1 = ds.dataserver_client()
+        c1.set_file_pool(max_files=2)
+        files = [c1.get_file('test_pool%d.h5' % i) for i in range(3)]
+        for i, f in enumerate(files):
+            f['data'] = np.arange(10) * i
+        stats = c1.get_stats()
+        assert stats['open_files'] <= 2, 'file pool exceeded its size'
+        assert np.all(files[0]['data'][:] == 0), 'data does not match after reopening'
+        assert c1.get_stats()['file_reopens'] >= 1, 'reopen not counted'
+
+    def testPinFile(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_pin_file.h5'
+        c1.pin_file(filename)
+        assert os.path.abspath(filename) in c1.list_files(), 'pinned file not opened'
+        c1.set_file_pool(max_files=0)
+        assert c1.get_stats()['open_files'] == 1, 'pinned file closed'
+        c1.pin_file(filename, False)
+        c1.set_file_pool(max_files=0)
+        stats = c1.get_stats()
+        assert stats['open_files'] == 0 and stats['file_closes'] == 1, 'unpinned file not closed'
+        c1.get_file(filename)['data'] = np.arange(10)
+        assert np.all(c1.get_file(filename)['data'][:] == np.arange(10)), 'data does not match after reopening'
+
+    def testResizeInPlace(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_resize_in_place.h5'
+        f1 = c1.get_file(filename)
+        f1['data'] = np.arange(10)
+        f1['data'].set_attrs(label='counts')
+        for n in range(20, 200, 20):
+            f1['data'] = np.arange(n)
+        assert np.all(f1['data'][:] == np.arange(180)), 'data does not match after resizing'
+        assert f1['data'].get_attrs()['label'] == 'counts', 'attributes lost when resizing'
+        sizes = c1.repack(filename)
+        assert sizes['after'] <= sizes['before'], 'repacking grew the file'
+        assert np.all(f1['data'][:] == np.arange(180)), 'data does not match after repacking'
+        f1['link'] = f1['data']
+        self.assertRaises(Exception, c1.repack, filename)
+        assert np.all(f1['link'][:] == np.arange(180)), 'data does not match after refused repack'
+
+        filename = 'test_small_arrays.h5'
+        f2 = c1.get_file(filename)
+        for i in range(100):
+            f2['rec%d' % i] = np.arange(10.)
+        f2.close()
+        size = os.path.getsize(os.path.join(ds.DATA_DIRECTORY, filename))
+        assert size < 100 * 8 * 1024, 'small arrays take %d bytes' % size
+
+    def testTable(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_table.h5')
+        t = f1.create_dataset('log', dtype=[('time', 'f8'), ('value', 'f4')])
+        t.append_rows({'time': np.arange(100.), 'value': np.random.rand(100)})
+        t.append_rows([(100. + i, 0.5) for i in range(10)])
+        assert len(t) == 110, 'expected 110 rows, got %d' % len(t)
+        assert np.all(t.get_column('time') == np.arange(110.)), 'time column does not match'
+        rows = t.query('time', 20, 29.5)
+        assert np.all(rows['time'] == np.arange(20., 30.)), 'query on monotonic column failed'
+        rows = t.query('value', 0.5, 0.5, columns=['time'])
+        assert np.all(rows['time'][-10:] == np.arange(100., 110.)), 'query by scanning failed'
+        rows = t.query('time', 20, 29.5, columns=['value'])
+        assert rows.dtype.names == ('value', ), 'query by binary search returned %s' % (rows.dtype, )
+
+    def testTableMonotonic(self):
+        c1 = ds.dataserver_client()
+        f1 = c1.get_file('test_table_monotonic.h5')
+        dtype = [('time', 'f8'), ('value', 'f4')]
+        t = f1.create_dataset('log', dtype=dtype)
+        t.append_rows({'time': np.arange(10.), 'value': np.zeros(10)})
+        t.extend(np.array([(5., 1.)], dtype=dtype))
+        rows = t.query('time', 4.5, 5.5)
+        assert len(rows) == 2, 'query after extend() found %d rows' % len(rows)
+
+        t.append((20., 2.))
+        assert len(t) == 12, 'append() did not add a row'
+        assert tuple(t[11]) == (20., 2.), 'appended row does not match'
+
+        data = np.zeros(12, dtype=dtype)
+        data['time'] = np.arange(12.)
+        s = f1.create_dataset('sorted', data=data)
+        data['time'] = np.arange(12.)[::-1]
+        f1['sorted'] = data
+        assert np.all(s.query('time', 2., 3.)['time'] == [3., 2.]), 'query after replacing table failed'
+        data = np.zeros(20, dtype=dtype)
+        data['time'] = np.arange(20.) % 5
+        f1['sorted'] = data
+        assert len(s.query('time', 1., 1.)) == 4, 'query after resizing table failed'
+
+class WorkersTestCase(ServerTestCase):
+    nworkers = 2
+
+    def testListFiles(self):
+        c1 = ds.dataserver_client()
+        names = ['test_workers%d.h5' % i for i in range(4)]
+        for name in names:
+            c1.get_file(name)['data'] = np.arange(10)
+        fns = set(os.path.abspath(name) for name in names)
+        assert fns <= set(c1.list_files()), 'files missing from list_files()'
+        c1.remove_file(names[0])
+        assert os.path.abspath(names[0]) not in c1.list_files(), 'removed file still listed'
+        assert np.all(c1.get_file(names[1])['data'][:] == np.arange(10)), 'data does not match'
+
+    def testFileAdded(self):
+        c1 = ds.dataserver_client()
+        added = []
+        c1.connect('file-added', added.append)
+        f1 = c1.get_file('test_file_added.h5')
+        f1.close()
+        c1.get_file('test_file_added.h5')
+        start = time.time()
+        while len(added) < 2 and time.time() - start < 5:
+            c1.hello()
+            time.sleep(0.1)
+        assert len(added) == 2, 'expected 2 file-added signals, got %d' % len(added)
+
+    def testQuit(self):
+        c1 = ds.dataserver_client()
+        filename = 'test_workers_quit.h5'
+        d = c1.get_file(filename).create_dataset('data', rank=1)
+        d.extend(np.arange(100))
+        c1.quit(async=True)
+        self.server_process.join(30)
+        assert not self.server_process.is_alive(), 'server did not quit'
+        f = h5py.File(os.path.join(ds.DATA_DIRECTORY, filename), 'r')
+        assert f['data'].shape == (100, ), 'worker did not close and trim its files'
+        f.close()
+
 if __name__ == "__main__":
     unittest.main()